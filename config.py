@@ -57,6 +57,8 @@ class Config:
         int
     ] = None  # Eval and Test should break after this many iterations (not epochs!) None runs whole test and val
     neo4j: bool = False  # Should the dataset use neo4j database or not
+    pin_memory: bool = True  # Load batches into page-locked memory, so host to device copies can be async
+    sampling_device: str = "cpu"  # Device GraphDataset samples the subgraphs on, "cuda" keeps the adjacencies and node features on the GPU
 
     def print(self):
         print("\nConfiguration is:")
@@ -88,6 +90,7 @@ class LightGCNConfig:
     num_iterations: int
     show_graph: bool
     num_recommendations: int
+    eval_batch_size: int = 4096  # (LightGCN) number of edges sampled for the validation/test loss
 
     def print(self):
         print("\nConfiguration is:")
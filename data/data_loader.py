@@ -3,6 +3,7 @@ from config import Config
 from data.types import ArticleIdMap, CustomerIdMap
 import torch as t
 import json
+import copy
 from typing import Tuple
 import torch_geometric.transforms as T
 from torch_geometric.loader import NeighborLoader, LinkNeighborLoader, DataLoader
@@ -45,11 +46,31 @@ def create_dataloaders(
         matchers=get_matchers(config.matchers, "test", config.candidate_pool_size),
     )
 
-    train_loader = DataLoader(train_dataset, batch_size=config.batch_size, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=config.batch_size, shuffle=True)
-    test_loader = DataLoader(test_dataset, batch_size=config.batch_size, shuffle=True)
+    # The collated HeteroData batches implement pin_memory(), so the loader can
+    # page-lock them for the non_blocking host to device copies during training.
+    # Batches sampled on the GPU are already there, only CPU memory can be pinned
+    pin_memory = config.pin_memory and t.device(config.sampling_device).type == "cpu"
+    train_loader = DataLoader(
+        train_dataset,
+        batch_size=config.batch_size,
+        shuffle=True,
+        pin_memory=pin_memory,
+    )
+    val_loader = DataLoader(
+        val_dataset,
+        batch_size=config.batch_size,
+        shuffle=True,
+        pin_memory=pin_memory,
+    )
+    test_loader = DataLoader(
+        test_dataset,
+        batch_size=config.batch_size,
+        shuffle=True,
+        pin_memory=pin_memory,
+    )
 
-    data = train_dataset.graph
+    # ToUndirected works in place, shallow copy the (cached, shared) graph first
+    data = copy.copy(train_dataset.graph)
     data = T.ToUndirected()(data)
 
     customer_id_map = read_json("data/derived/customer_id_map_forward.json")
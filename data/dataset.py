@@ -1,13 +1,20 @@
 import torch as t
 import math
+import os
 from torch_geometric.data import Data, HeteroData, InMemoryDataset
 from torch import Tensor
 from typing import Tuple, Union, Optional, List
 from .matching.type import Matcher
 from utils.constants import Constants
 from config import Config
-from utils.flatten import flatten
-import random
+from utils.cache import load_cached
+from .n_hop_numba import NUMBA_AVAILABLE, fetch_n_hop_neighbourhood_numba
+from utils.tensor import (
+    csr_neighbours,
+    csr_edges,
+    unique_unsorted,
+    load_adjacency_csr,
+)
 
 device = t.device("cuda" if t.cuda.is_available() else "cpu")
 
@@ -25,26 +32,53 @@ class GraphDataset(InMemoryDataset):
         split_type: Optional[str] = None,
     ):
 
-        self.graph = t.load(graph_path)
-        self.articles = t.load(articles_adj_list)
-        self.users = t.load(users_adj_list)
+        self.graph = load_cached(graph_path)
+        # Everything a sample touches lives on the sampling device, .to() is a no-op on the CPU
+        self.device = t.device(config.sampling_device)
+        self.users_csr = tuple(
+            tensor.to(self.device)
+            for tensor in load_adjacency_csr(
+                users_adj_list, self.graph[Constants.node_user].num_nodes
+            )
+        )
+        self.articles_csr = tuple(
+            tensor.to(self.device)
+            for tensor in load_adjacency_csr(
+                articles_adj_list, self.graph[Constants.node_item].num_nodes
+            )
+        )
+        self.user_features = self.graph[Constants.node_user].x.to(self.device)
+        self.article_features = self.graph[Constants.node_item].x.to(self.device)
+        # Number of users with at least one edge (the keys of the adjacency dict)
+        users_indptr = self.users_csr[0]
+        self.length = int((users_indptr[1:] > users_indptr[:-1]).sum())
+        # Persistent buffers for the n-hop expansion, to dedup users without sorting
+        num_users = self.graph[Constants.node_user].num_nodes
+        self.users_visited = t.zeros(num_users, dtype=t.bool, device=self.device)
+        self.users_scratch = t.empty(num_users, dtype=t.long, device=self.device)
+        # The negative sampling bounds are static, no need to reduce over the edges per sample
+        all_edges = self.graph[Constants.edge_key].edge_index
+        self.num_edges = all_edges.shape[1]
+        self.article_id_max = int(all_edges[1].max())
+        # Negatives are drawn in bulk for many samples at once
+        self.random_pool = RandomIntegerPool(device=self.device)
+        # Persistent mask for rejecting the positive articles of a sample
+        self.is_positive = t.zeros(
+            self.article_id_max + 1, dtype=t.bool, device=self.device
+        )
         self.matchers = matchers
         self.config = config
         self.train = train
         self.randomization = randomization
 
     def __len__(self) -> int:
-        return len(self.users)
+        return self.length
 
     def __getitem__(self, idx: int) -> Union[Data, HeteroData]:
         """Create Edges"""
-        all_edges = self.graph[Constants.edge_key].edge_index
-        positive_article_indices = t.as_tensor(
-            self.users[idx], dtype=t.long
+        positive_article_indices = csr_neighbours(
+            *self.users_csr, idx
         )  # all the positive target indices for the current user
-        positive_article_edges = create_edges_from_target_indices(
-            idx, positive_article_indices
-        )
 
         # Sample positive edges from subgraph (amount defined in config.positive_edges_ratio)
         samp_cut = max(
@@ -56,20 +90,17 @@ class GraphDataset(InMemoryDataset):
 
         if self.randomization:
             random_integers = t.randint(
-                low=0, high=len(positive_article_indices), size=(samp_cut,)
+                low=0,
+                high=len(positive_article_indices),
+                size=(samp_cut,),
+                device=self.device,
             )
         else:
-            random_integers = t.tensor(
-                [
-                    t.min(positive_article_indices, dim=0)[1].item(),
-                    t.max(positive_article_indices, dim=0)[1].item(),
-                ]
+            random_integers = t.stack(
+                [positive_article_indices.argmin(), positive_article_indices.argmax()]
             )
 
         sampled_positive_article_indices = positive_article_indices[random_integers]
-        sampled_positive_article_edges = create_edges_from_target_indices(
-            idx, sampled_positive_article_indices
-        )
 
         num_sampled_pos_edges = sampled_positive_article_indices.shape[0]
         if num_sampled_pos_edges <= 1:
@@ -79,84 +110,86 @@ class GraphDataset(InMemoryDataset):
 
         if self.train:
             # Randomly select from the whole graph
-            sampled_negative_article_edges = create_edges_from_target_indices(
-                idx,
-                get_negative_edges_random(
-                    subgraph_edges_to_filter=sampled_positive_article_indices,
-                    all_edges=all_edges,
-                    num_negative_edges=int(
-                        negative_edges_ratio * num_sampled_pos_edges
-                    ),
-                    randomization=self.randomization,
-                ),
+            sampled_negative_article_indices = get_negative_edges_random(
+                subgraph_edges_to_filter=sampled_positive_article_indices,
+                num_edges=self.num_edges,
+                id_max=self.article_id_max,
+                num_negative_edges=int(negative_edges_ratio * num_sampled_pos_edges),
+                randomization=self.randomization,
+                random_pool=self.random_pool,
+                is_positive=self.is_positive,
             )
         else:
             assert self.matchers is not None, "Must provide matchers for test"
             # Select according to a heuristic (eg.: lightgcn scores)
             candidates = t.cat(
-                [matcher.get_matches(idx) for matcher in self.matchers],
+                [matcher.get_matches(idx).to(self.device) for matcher in self.matchers],
                 dim=0,
             ).unique()
             # but never add positive edges
-            sampled_negative_article_edges = create_edges_from_target_indices(
-                idx,
-                only_items_with_count_one(
-                    t.cat([candidates, positive_article_indices], dim=0)
-                ),
+            sampled_negative_article_indices = only_items_with_count_one(
+                t.cat([candidates, positive_article_indices], dim=0)
             )
 
-        n_hop_edges = fetch_n_hop_neighbourhood(
-            self.config.n_hop_neighbors,
-            idx,
-            self.users,
-            self.articles,
-            num_neighbors=self.config.num_neighbors,
-        )
+        if NUMBA_AVAILABLE and self.device.type == "cpu":
+            n_hop_edges = fetch_n_hop_neighbourhood_numba(
+                self.config.n_hop_neighbors,
+                idx,
+                self.users_csr,
+                self.articles_csr,
+                num_neighbors=self.config.num_neighbors,
+                users_visited=self.users_visited,
+            )
+        else:
+            n_hop_edges = fetch_n_hop_neighbourhood(
+                self.config.n_hop_neighbors,
+                idx,
+                self.users_csr,
+                self.articles_csr,
+                num_neighbors=self.config.num_neighbors,
+                users_visited=self.users_visited,
+                users_scratch=self.users_scratch,
+            )
 
-        all_touched_edges = t.cat(
-            [
-                positive_article_edges,
-                sampled_negative_article_edges,
-                n_hop_edges,
-            ],
-            dim=1,
-        )
+        # Subgraph edges first, then sampled edges, written into one preallocated tensor.
+        # The sampled positives are a subset of the positive edges, so this touches
+        # exactly the same nodes as the subgraph + negatives
+        num_positive = len(positive_article_indices)
+        num_subgraph_edges = num_positive + n_hop_edges.shape[1]
+        num_sampled_positive = len(sampled_positive_article_indices)
+        num_sampled = num_sampled_positive + len(sampled_negative_article_indices)
 
-        all_subgraph_edges = t.cat(
-            [
-                positive_article_edges,
-                n_hop_edges,
-            ],
-            dim=1,
+        all_touched_edges = t.empty(
+            (2, num_subgraph_edges + num_sampled), dtype=t.long, device=self.device
         )
+        # every edge, except the n-hop ones, starts from the current user
+        all_touched_edges[0] = idx
+        all_touched_edges[1, :num_positive] = positive_article_indices
+        all_touched_edges[:, num_positive:num_subgraph_edges] = n_hop_edges
+        sampled_targets = all_touched_edges[1, num_subgraph_edges:]
+        sampled_targets[:num_sampled_positive] = sampled_positive_article_indices
+        sampled_targets[num_sampled_positive:] = sampled_negative_article_indices
 
         """ Node Features """
-        user_buckets = t.unique(all_touched_edges[0], sorted=True)
-        article_buckets = t.unique(all_touched_edges[1], sorted=True)
+        # A single sort per node type yields both the buckets and the remapped edges
+        user_buckets, remapped_users = t.unique(
+            all_touched_edges[0], sorted=True, return_inverse=True
+        )
+        article_buckets, remapped_articles = t.unique(
+            all_touched_edges[1], sorted=True, return_inverse=True
+        )
 
-        user_features = self.graph[Constants.node_user].x[user_buckets]
-        article_features = self.graph[Constants.node_item].x[article_buckets]
+        user_features = self.user_features[user_buckets]
+        article_features = self.article_features[article_buckets]
 
         """ Remap and Prepare Edges """
-        all_subgraph_edges = remap_edges_to_start_from_zero(
-            all_subgraph_edges, user_buckets, article_buckets
-        )
-        all_sampled_edges = remap_edges_to_start_from_zero(
-            t.cat(
-                [sampled_positive_article_edges, sampled_negative_article_edges], dim=1
-            ),
-            user_buckets,
-            article_buckets,
-        )
+        all_touched_edges = t.stack([remapped_users, remapped_articles])
+        all_subgraph_edges = all_touched_edges[:, :num_subgraph_edges]
+        all_sampled_edges = all_touched_edges[:, num_subgraph_edges:]
 
         # Prepare identifier of labels
-        labels = t.cat(
-            [
-                t.ones(sampled_positive_article_edges.shape[1]),
-                t.zeros(sampled_negative_article_edges.shape[1]),
-            ],
-            dim=0,
-        )
+        labels = t.zeros(num_sampled, dtype=t.long, device=self.device)
+        labels[:num_sampled_positive] = 1
 
         # all_sampled_edges, labels = shuffle_edges_and_labels(all_sampled_edges, labels)
 
@@ -165,20 +198,15 @@ class GraphDataset(InMemoryDataset):
         data[Constants.node_user].x = user_features
         data[Constants.node_item].x = article_features
 
-        # Add original directional edges
-        data[Constants.edge_key].edge_index = all_subgraph_edges.type(t.long)
-        data[Constants.edge_key].edge_label_index = all_sampled_edges.type(t.long)
-        data[Constants.edge_key].edge_label = labels.type(t.long)
+        # Add original directional edges (everything above is already long)
+        data[Constants.edge_key].edge_index = all_subgraph_edges
+        data[Constants.edge_key].edge_label_index = all_sampled_edges
+        data[Constants.edge_key].edge_label = labels
 
         # Add reverse edges
-        reverse_key = t.LongTensor([1, 0])
-        data[Constants.rev_edge_key].edge_index = all_subgraph_edges[reverse_key].type(
-            t.long
-        )
-        data[Constants.rev_edge_key].edge_label_index = all_sampled_edges[
-            reverse_key
-        ].type(t.long)
-        data[Constants.rev_edge_key].edge_label = labels.type(t.long)
+        data[Constants.rev_edge_key].edge_index = all_subgraph_edges.flip(0)
+        data[Constants.rev_edge_key].edge_label_index = all_sampled_edges.flip(0)
+        data[Constants.rev_edge_key].edge_label = labels
         return data
 
 
@@ -189,121 +217,139 @@ def only_items_with_count_one(input: t.Tensor) -> t.Tensor:
 
 def get_negative_edges_random(
     subgraph_edges_to_filter: Tensor,
-    all_edges: Tensor,
+    num_edges: int,
+    id_max: int,
     num_negative_edges: int,
     randomization: bool,
+    random_pool: Optional["RandomIntegerPool"] = None,
+    is_positive: Optional[Tensor] = None,
 ) -> Tensor:
-
-    # Get the biggest value available in articles (potential edges to sample from)
-    id_max = t.max(all_edges, dim=1)[0][1]
-
-    if all_edges.shape[1] / num_negative_edges > 100:
+    """`id_max` is the biggest value available in articles (potential edges to sample from),
+    `num_edges` the number of edges in the whole graph. Both are static, callers compute them once.
+    `is_positive` is an all False bool buffer of at least `id_max + 1` entries, restored before returning.
+    The negatives are sampled on the device of `subgraph_edges_to_filter`."""
+    device = subgraph_edges_to_filter.device
+    if num_edges / num_negative_edges > 100:
         # If the number of edges is high, it is unlikely we get a positive edge, no need for expensive filter operations
-        if randomization:
+        if randomization and random_pool is not None:
+            random_integers = random_pool.sample(num_negative_edges, id_max)
+        elif randomization:
             random_integers = t.randint(
-                low=0, high=id_max.item(), size=(num_negative_edges,)
+                low=0, high=id_max, size=(num_negative_edges,), device=device
             )
         else:
-            random_integers = t.tensor([id_max.item()])
+            random_integers = t.tensor([id_max], device=device)
 
         return random_integers
 
     else:
-        # Create list of potential negative edges, filter out positive edges
-        only_negative_edges = only_items_with_count_one(
-            t.cat(
-                (
-                    t.arange(start=0, end=id_max + 1, dtype=t.int64),
-                    subgraph_edges_to_filter,
-                ),
-                dim=0,
+        # Randomly sample negative edges, rejecting the positive ones with a mask lookup
+        if randomization:
+            if is_positive is None:
+                is_positive = t.zeros(id_max + 1, dtype=t.bool, device=device)
+            is_positive[subgraph_edges_to_filter] = True
+            num_negative_edges = min(
+                num_negative_edges,
+                id_max + 1 - len(t.unique(subgraph_edges_to_filter)),
             )
-        )
 
-        # Randomly sample negative edges
-        if randomization:
-            random_integers = t.randperm(only_negative_edges.nelement())
-            negative_edges = only_negative_edges[random_integers][:num_negative_edges]
+            negative_edges = t.tensor([], dtype=t.long, device=device)
+            while len(negative_edges) < num_negative_edges:
+                random_integers = t.randint(
+                    low=0,
+                    high=id_max + 1,
+                    size=(int(num_negative_edges * 1.5) + 1,),
+                    device=device,
+                )
+                negative_edges = t.cat(
+                    [negative_edges, random_integers[~is_positive[random_integers]]],
+                    dim=0,
+                )
+            negative_edges = negative_edges[:num_negative_edges]
+            # Only the entries set above are cleared, the buffer is reused by the next sample
+            is_positive[subgraph_edges_to_filter] = False
         else:
-            negative_edges = t.tensor([id_max.item()])
+            negative_edges = t.tensor([id_max], device=device)
 
         return negative_edges
 
 
-def remap_edges_to_start_from_zero(
-    edges: Tensor, buckets_1st_dim: Tensor, buckets_2nd_dim: Tensor
-) -> Tensor:
-    return t.stack(
-        (
-            t.bucketize(edges[0], buckets_1st_dim),
-            t.bucketize(edges[1], buckets_2nd_dim),
-        )
-    )
-
-
-def create_edges_from_target_indices(
-    source_index: int, target_indices: Tensor
-) -> Tensor:
-    """Expand target indices list with user's id to have shape [2, num_nodes]"""
+class RandomIntegerPool:
+    """Hands out uniform random integers in [0, high) from a buffer that is refilled with a single
+    t.randint call, instead of launching one small randint per sample"""
+
+    def __init__(self, pool_size: int = 65536, device: t.device = t.device("cpu")):
+        self.pool_size = pool_size
+        self.device = device
+        self.pool = t.tensor([], dtype=t.long, device=device)
+        self.position = 0
+        self.high = -1
+        self.pid = -1
+
+    def sample(self, n: int, high: int) -> Tensor:
+        # Refill in each (forked) DataLoader worker, so workers never share the same draws
+        if (
+            self.position + n > len(self.pool)
+            or high != self.high
+            or os.getpid() != self.pid
+        ):
+            self.pool = t.randint(
+                low=0, high=high, size=(max(self.pool_size, n),), device=self.device
+            )
+            self.position = 0
+            self.high = high
+            self.pid = os.getpid()
 
-    return t.stack(
-        [
-            t.Tensor([source_index]).to(dtype=t.long).repeat(len(target_indices)),
-            t.as_tensor(target_indices, dtype=t.long),
-        ],
-        dim=0,
-    )
+        random_integers = self.pool[self.position : self.position + n]
+        self.position += n
+        return random_integers
 
 
 def fetch_n_hop_neighbourhood(
-    n: int, user_id: int, users: dict, articles: dict, num_neighbors: int
+    n: int,
+    user_id: int,
+    users_csr: Tuple[Tensor, Tensor],
+    articles_csr: Tuple[Tensor, Tensor],
+    num_neighbors: int,
+    users_visited: Tensor,
+    users_scratch: Tensor,
 ) -> t.Tensor:
-    """Returns the edges from the n-hop neighbourhood of the user, without the direct links for the same user"""
-    accum_edges = t.tensor([[], []], dtype=t.long)
-    users_explored = set([])
-    users_queue = set([user_id])
+    """Returns the edges from the n-hop neighbourhood of the user, without the direct links for the same user.
+    `users_visited` has to be all False, it is restored before returning, `users_scratch` is overwritten.
+    Runs on the device of the CSR tensors."""
+    device = users_csr[0].device
+    accum_edges = [t.tensor([[], []], dtype=t.long, device=device)]
+    users_explored = [t.tensor([], dtype=t.long, device=device)]
+    users_queue = t.tensor([user_id], dtype=t.long, device=device)
 
     for i in range(0, n):
-        new_articles_and_edges = [
-            create_neighbouring_article_edges(user, users) for user in users_queue
-        ]
-        users_explored = users_explored | users_queue
-        if len(new_articles_and_edges) == 0:
+        if len(users_queue) == 0:
             break
-        new_articles = flatten([x[0] for x in new_articles_and_edges])
+        new_edges = csr_edges(*users_csr, users_queue)
+        users_visited[users_queue] = True
+        users_explored.append(users_queue)
 
         if i != 0:
-            new_edges = t.cat([x[1] for x in new_articles_and_edges], dim=1)
-            accum_edges = t.cat([accum_edges, new_edges], dim=1)
+            accum_edges.append(new_edges)
 
-        articles_queue = shuffle_and_cut(new_articles, num_neighbors)
-        new_users = (
-            set(flatten([articles[article] for article in articles_queue]))
-            - users_explored
-        )  # remove the intersection between the two sets, so we only explore a user once
-        users_queue = set(shuffle_and_cut(list(new_users), num_neighbors))
+        articles_queue = shuffle_and_cut(new_edges[1], num_neighbors)
+        new_users = csr_edges(*articles_csr, articles_queue)[1]
+        # remove the users already explored, so we only explore a user once
+        new_users = unique_unsorted(new_users[~users_visited[new_users]], users_scratch)
+        users_queue = shuffle_and_cut(new_users, num_neighbors)
 
-    return accum_edges
+    # only reset what we touched, to keep this O(explored users)
+    users_visited[t.cat(users_explored, dim=0)] = False
+    return t.cat(accum_edges, dim=1)
 
 
-def shuffle_and_cut(array: list, n: int) -> list:
+def shuffle_and_cut(array: Tensor, n: int) -> Tensor:
     if len(array) > n:
-        return random.sample(array, n)
+        return array[t.randperm(len(array), device=array.device)[:n]]
     else:
         return array
 
 
-def create_neighbouring_article_edges(
-    user_id: int, users: dict
-) -> Tuple[List[int], Tensor]:
-    """Fetch neighbouring articles for a user, returns the article ids (list[int]) & edges (Tensor)"""
-    articles_purchased = users[user_id]
-    edges_to_articles = create_edges_from_target_indices(
-        user_id, t.as_tensor(articles_purchased, dtype=t.long)
-    )
-    return articles_purchased, edges_to_articles
-
-
 def shuffle_edges_and_labels(edges: Tensor, labels: Tensor) -> Tuple[Tensor, Tensor]:
     new_edge_order = t.randperm(edges.size(1))
     return (edges[:, new_edge_order], labels[new_edge_order])
@@ -7,11 +7,13 @@ from typing import Tuple, Union, Optional, List
 from .matching.type import Matcher
 from utils.constants import Constants
 from config import Config
+from utils.cache import load_cached
 from utils.flatten import flatten
 import random
 from data.neo4j.neo4j_database import Database
 from data.neo4j.utils import get_neighborhood, get_id_map
-from utils.tensor import check_edge_index_flat_unique
+from utils.tensor import check_edge_index_flat_unique, remap_to_positions
+from .dataset import get_negative_edges_random
 from collections import defaultdict
 
 
@@ -32,7 +34,9 @@ class GraphDataset(InMemoryDataset):
         db_param: Tuple[str, str, str] = ("bolt://localhost:7687", "neo4j", "password"),
     ):
 
-        self.graph = t.load(graph_path)
+        # Only the read-only graph is shared through the cache, the adjacency dicts
+        # are per-instance so mutating them cannot leak into the other splits
+        self.graph = load_cached(graph_path)
         self.articles = t.load(articles_adj_list)
         self.users = t.load(users_adj_list)
         self.matchers = matchers
@@ -41,6 +45,20 @@ class GraphDataset(InMemoryDataset):
         self.randomization = randomization
         self.db = Database(db_param[0], db_param[1], db_param[2])
         self.split_type = split_type
+        # The negative sampling bounds are static, no need to reduce over the edges per sample
+        self.num_edges = {
+            edge_type: self.graph[edge_type].edge_index.shape[1]
+            for edge_type in config.default_edge_types
+        }
+        self.target_id_max = {
+            edge_type: int(self.graph[edge_type].edge_index[1].max())
+            for edge_type in config.default_edge_types
+        }
+        # Persistent masks for rejecting the positive targets of a sample
+        self.is_positive = {
+            edge_type: t.zeros(target_id_max + 1, dtype=t.bool)
+            for edge_type, target_id_max in self.target_id_max.items()
+        }
 
     def __len__(self) -> int:
         return len(self.users)
@@ -172,8 +190,6 @@ class GraphDataset(InMemoryDataset):
         edge_label = dict()
 
         for edge_type in self.config.default_edge_types:
-            all_edges = self.graph[edge_type].edge_index
-
             """ Positive Sample """
             # We will have to modify self.users to be a disctionary of self.users[idx][edge_type]
             positive_article_indices = t.as_tensor(self.users[idx], dtype=t.long)
@@ -190,7 +206,7 @@ class GraphDataset(InMemoryDataset):
                 negative_edges_ratio = self.config.negative_edges_ratio
 
             negative_sample = self.get_negative_sampled_edges(
-                all_edges,
+                edge_type,
                 positive_sample,
                 positive_article_indices,
                 idx,
@@ -227,11 +243,8 @@ class GraphDataset(InMemoryDataset):
                 low=0, high=len(positive_article_indices), size=(samp_cut,)
             )
         else:
-            random_integers = t.tensor(
-                [
-                    t.min(positive_article_indices, dim=0)[1].item(),
-                    t.max(positive_article_indices, dim=0)[1].item(),
-                ]
+            random_integers = t.stack(
+                [positive_article_indices.argmin(), positive_article_indices.argmax()]
             )
 
         sampled_positive_article_indices = positive_article_indices[random_integers]
@@ -242,7 +255,7 @@ class GraphDataset(InMemoryDataset):
 
     def get_negative_sampled_edges(
         self,
-        all_edges: Tensor,
+        edge_type: Tuple[str, str, str],
         sampled_positive_article_indices: Tensor,
         positive_article_indices: Tensor,
         idx: int,
@@ -255,11 +268,13 @@ class GraphDataset(InMemoryDataset):
                 idx,
                 get_negative_edges_random(
                     subgraph_edges_to_filter=sampled_positive_article_indices,
-                    all_edges=all_edges,
+                    num_edges=self.num_edges[edge_type],
+                    id_max=self.target_id_max[edge_type],
                     num_negative_edges=int(
                         negative_edges_ratio * num_sampled_pos_edges
                     ),
                     randomization=self.randomization,
+                    is_positive=self.is_positive[edge_type],
                 ),
             )
         else:
@@ -284,56 +299,13 @@ def only_items_with_count_one(input: t.Tensor) -> t.Tensor:
     return uniques[counts == 1]
 
 
-def get_negative_edges_random(
-    subgraph_edges_to_filter: Tensor,
-    all_edges: Tensor,
-    num_negative_edges: int,
-    randomization: bool,
-) -> Tensor:
-
-    # Get the biggest value available in articles (potential edges to sample from)
-    id_max = t.max(all_edges, dim=1)[0][1]
-
-    if all_edges.shape[1] / num_negative_edges > 100:
-        # If the number of edges is high, it is unlikely we get a positive edge, no need for expensive filter operations
-        if randomization:
-            random_integers = t.randint(
-                low=0, high=id_max.item(), size=(num_negative_edges,)
-            )
-        else:
-            random_integers = t.tensor([id_max.item()])
-
-        return random_integers
-
-    else:
-        # Create list of potential negative edges, filter out positive edges
-        only_negative_edges = only_items_with_count_one(
-            t.cat(
-                (
-                    t.arange(start=0, end=id_max + 1, dtype=t.int64),
-                    subgraph_edges_to_filter,
-                ),
-                dim=0,
-            )
-        )
-
-        # Randomly sample negative edges
-        if randomization:
-            random_integers = t.randperm(only_negative_edges.nelement())
-            negative_edges = only_negative_edges[random_integers][:num_negative_edges]
-        else:
-            negative_edges = t.tensor([id_max.item()])
-
-        return negative_edges
-
-
 def remap_edges_to_start_from_zero(
     edges: Tensor, buckets_1st_dim: Tensor, buckets_2nd_dim: Tensor
 ) -> Tensor:
     return t.stack(
         (
-            t.bucketize(edges[0], buckets_1st_dim),
-            t.bucketize(edges[1], buckets_2nd_dim),
+            remap_to_positions(edges[0], buckets_1st_dim),
+            remap_to_positions(edges[1], buckets_2nd_dim),
         )
     )
 
@@ -345,7 +317,7 @@ def create_edges_from_target_indices(
 
     return t.stack(
         [
-            t.Tensor([source_index]).to(dtype=t.long).repeat(len(target_indices)),
+            t.full((len(target_indices),), source_index, dtype=t.long),
             t.as_tensor(target_indices, dtype=t.long),
         ],
         dim=0,
@@ -1,8 +1,7 @@
-import random
 from sklearn.model_selection import train_test_split
 import torch as t
+import numpy as np
 from torch_sparse import SparseTensor
-from torch_geometric.utils import structured_negative_sampling
 import json
 
 """# Loading the Dataset
@@ -15,7 +14,8 @@ def split(edge_index):
     # split the edges of the graph using a 80/10/10 train/validation/test split
 
     num_interactions = edge_index.shape[1]
-    all_indices = [i for i in range(num_interactions)]
+    # an index array instead of a python list: same split, without boxing every position
+    all_indices = np.arange(num_interactions)
 
     train_indices, test_indices = train_test_split(
         all_indices, test_size=0.2, random_state=1
@@ -24,9 +24,9 @@ def split(edge_index):
         test_indices, test_size=0.5, random_state=1
     )
 
-    train_edge_index = edge_index[:, train_indices]
-    val_edge_index = edge_index[:, val_indices]
-    test_edge_index = edge_index[:, test_indices]
+    train_edge_index = edge_index[:, t.from_numpy(train_indices)]
+    val_edge_index = edge_index[:, t.from_numpy(val_indices)]
+    test_edge_index = edge_index[:, t.from_numpy(test_indices)]
 
     return train_edge_index, val_edge_index, test_edge_index, edge_index
 
@@ -37,10 +37,10 @@ def read_json(filename: str):
 
 
 def both_indexes_from_zero(edge_index):
-    new_edge_index = t.clone(edge_index)
-    new_edge_index[1] = new_edge_index[1] - (t.max(new_edge_index[0]) + 1)
+    # in place, the edge index comes straight from to_homogeneous so nobody else holds it
+    edge_index[1] -= t.max(edge_index[0]) + 1
 
-    return new_edge_index
+    return edge_index
 
 
 def index_based_mapping(id_based_mapping):
@@ -91,22 +91,48 @@ def create_dataloaders_lightgcn():
     )
 
 
+def positive_edge_keys(edge_index, num_items):
+    """Sorted `user * num_items + item` keys of the edges, membership is then a binary search"""
+    return t.sort(edge_index[0] * num_items + edge_index[1])[0]
+
+
 # function which random samples a mini-batch of positive and negative samples
-def sample_mini_batch(batch_size, edge_index):
-    """Randomly samples indices of a minibatch given an adjacency matrix
+def sample_mini_batch(batch_size, edge_index, num_items=None, positive_keys=None):
+    """Randomly samples indices of a minibatch given an adjacency matrix.
+    Only the sampled edges get a negative item, instead of negative sampling the whole edge index.
 
     Args:
         batch_size (int): minibatch size
         edge_index (t.Tensor): 2 by N list of edges
+        num_items (int, optional): negatives are drawn from [0, num_items). Defaults to the largest item id + 1.
+        positive_keys (t.Tensor, optional): positive_edge_keys(edge_index, num_items), pass it to reuse it between calls
 
     Returns:
         tuple: user indices, positive item indices, negative item indices
     """
-    edges = structured_negative_sampling(
-        edge_index.to("cpu"), num_nodes=t.max(edge_index[1]).to("cpu")
-    )
-    edges = t.stack(edges, dim=0)
-    indices = random.choices([i for i in range(edges[0].shape[0])], k=batch_size)
-    batch = edges[:, indices]
-    user_indices, pos_item_indices, neg_item_indices = batch[0], batch[1], batch[2]
+    if num_items is None:
+        num_items = int(t.max(edge_index[1])) + 1
+    if positive_keys is None:
+        positive_keys = positive_edge_keys(edge_index, num_items)
+
+    device = edge_index.device
+    indices = t.randint(0, edge_index.shape[1], (batch_size,), device=device)
+    user_indices, pos_item_indices = edge_index[0][indices], edge_index[1][indices]
+
+    def is_positive(users, items):
+        keys = users * num_items + items
+        found = t.searchsorted(positive_keys, keys).clamp(max=len(positive_keys) - 1)
+        return positive_keys[found] == keys
+
+    # rejection sampling, only the (few) negatives that hit a positive edge are redrawn
+    neg_item_indices = t.randint(0, num_items, (batch_size,), device=device)
+    resample = is_positive(user_indices, neg_item_indices)
+    while resample.any():
+        neg_item_indices[resample] = t.randint(
+            0, num_items, (int(resample.sum()),), device=device
+        )
+        resample[resample.clone()] = is_positive(
+            user_indices[resample], neg_item_indices[resample]
+        )
+
     return user_indices, pos_item_indices, neg_item_indices
@@ -4,7 +4,9 @@ import torch as t
 
 class LightGCNMatcher(Matcher):
     def __init__(self, k: int):  # : Literal["train", "test", "val"]
-        self.top_articles_per_user = t.load("data/derived/lightgcn_output.pt")
+        self.top_articles_per_user = t.load(
+            "data/derived/lightgcn_output.pt", map_location="cpu"
+        )
         self.k = k
 
     def get_matches(self, user_id: int) -> t.Tensor:
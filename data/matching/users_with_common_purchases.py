@@ -1,26 +1,21 @@
 # from typing import Literal
-from utils.flatten import flatten
 from .type import Matcher
+from utils.tensor import load_adjacency_csr, csr_neighbours, csr_edges
 import torch as t
 from torch import Tensor
 
 
 class UsersWithCommonItemsMatcher(Matcher):
     def __init__(self, k: int, suffix):  ##: Literal["train", "test", "val"]):
-        self.user_to_articles = t.load(f"data/derived/edges_{suffix}.pt")
-        self.article_to_users = t.load(f"data/derived/rev_edges_{suffix}.pt")
+        self.users_csr = load_adjacency_csr(f"data/derived/edges_{suffix}.pt")
+        self.articles_csr = load_adjacency_csr(f"data/derived/rev_edges_{suffix}.pt")
         self.k = k
 
     def get_matches(self, user_id: int) -> t.Tensor:
-        articles_purchased = self.user_to_articles[user_id]
-        users_with_same_articles = flatten(
-            [self.article_to_users[article] for article in articles_purchased]
-        )
-        articles_purchased_by_common_users = t.cat(
-            [
-                t.as_tensor(self.user_to_articles[user])
-                for user in users_with_same_articles
-            ],
-            dim=0,
-        )
+        articles_purchased = csr_neighbours(*self.users_csr, user_id)
+        # one CSR gather per hop instead of a python list per article and per user
+        users_with_same_articles = csr_edges(*self.articles_csr, articles_purchased)[1]
+        articles_purchased_by_common_users = csr_edges(
+            *self.users_csr, users_with_same_articles
+        )[1]
         return articles_purchased_by_common_users[: self.k]
@@ -0,0 +1,131 @@
+import numpy as np
+import torch as t
+from torch import Tensor
+from typing import Tuple
+
+try:
+    from numba import njit
+
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # GraphDataset falls back to the vectorized torch version in data/dataset.py
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        return lambda function: function
+
+
+def fetch_n_hop_neighbourhood_numba(
+    n: int,
+    user_id: int,
+    users_csr: Tuple[Tensor, Tensor],
+    articles_csr: Tuple[Tensor, Tensor],
+    num_neighbors: int,
+    users_visited: Tensor,
+) -> Tensor:
+    """Same contract as data.dataset.fetch_n_hop_neighbourhood, but the whole traversal runs in one compiled call.
+    The CSR tensors and `users_visited` are handed over as numpy views, nothing is copied"""
+    # numba has its own RNG, seed it from torch so seed_everything keeps runs reproducible
+    seed = int(t.randint(0, 2**31 - 1, (1,)))
+    sources, targets = _expand_n_hops(
+        n,
+        user_id,
+        users_csr[0].numpy(),
+        users_csr[1].numpy(),
+        articles_csr[0].numpy(),
+        articles_csr[1].numpy(),
+        num_neighbors,
+        users_visited.numpy(),
+        seed,
+    )
+    return t.from_numpy(np.stack((sources, targets)))
+
+
+@njit(cache=True)
+def _grow(array: np.ndarray, size: int) -> np.ndarray:
+    grown = np.empty(max(2 * array.shape[0], size), dtype=array.dtype)
+    grown[: array.shape[0]] = array
+    return grown
+
+
+@njit(cache=True)
+def _expand_n_hops(
+    n,
+    user_id,
+    users_indptr,
+    users_indices,
+    articles_indptr,
+    articles_indices,
+    num_neighbors,
+    visited,
+    seed,
+):
+    np.random.seed(seed)
+    accum_sources = np.empty(0, dtype=np.int64)
+    accum_targets = np.empty(0, dtype=np.int64)
+    num_accum = 0
+    explored = np.empty(0, dtype=np.int64)
+    num_explored = 0
+    queue = np.full(1, user_id, dtype=np.int64)
+
+    for i in range(n):
+        if queue.shape[0] == 0:
+            break
+
+        num_edges = 0
+        for user in queue:
+            num_edges += users_indptr[user + 1] - users_indptr[user]
+        sources = np.empty(num_edges, dtype=np.int64)
+        targets = np.empty(num_edges, dtype=np.int64)
+        k = 0
+        for user in queue:
+            visited[user] = True
+            for j in range(users_indptr[user], users_indptr[user + 1]):
+                sources[k] = user
+                targets[k] = users_indices[j]
+                k += 1
+
+        if num_explored + queue.shape[0] > explored.shape[0]:
+            explored = _grow(explored, num_explored + queue.shape[0])
+        explored[num_explored : num_explored + queue.shape[0]] = queue
+        num_explored += queue.shape[0]
+
+        if i != 0:
+            if num_accum + num_edges > accum_sources.shape[0]:
+                accum_sources = _grow(accum_sources, num_accum + num_edges)
+                accum_targets = _grow(accum_targets, num_accum + num_edges)
+            accum_sources[num_accum : num_accum + num_edges] = sources
+            accum_targets[num_accum : num_accum + num_edges] = targets
+            num_accum += num_edges
+
+        # same as shuffle_and_cut in data/dataset.py
+        if num_edges > num_neighbors:
+            articles = np.random.permutation(targets)[:num_neighbors]
+        else:
+            articles = targets
+
+        num_candidates = 0
+        for article in articles:
+            num_candidates += articles_indptr[article + 1] - articles_indptr[article]
+        candidates = np.empty(num_candidates, dtype=np.int64)
+        k = 0
+        for article in articles:
+            for j in range(articles_indptr[article], articles_indptr[article + 1]):
+                user = articles_indices[j]
+                # marking the candidates as visited dedups them, it is undone right after
+                if not visited[user]:
+                    visited[user] = True
+                    candidates[k] = user
+                    k += 1
+        for j in range(k):
+            visited[candidates[j]] = False
+
+        if k > num_neighbors:
+            queue = np.random.permutation(candidates[:k])[:num_neighbors].copy()
+        else:
+            queue = candidates[:k].copy()
+
+    # only reset what we touched, to keep this O(explored users)
+    for j in range(num_explored):
+        visited[explored[j]] = False
+    return accum_sources[:num_accum].copy(), accum_targets[:num_accum].copy()
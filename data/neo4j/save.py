@@ -1,9 +1,8 @@
 import pandas as pd
 import os
 import time
-from utils.pandas import drop_columns_if_exist
 import numpy as np
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple, Union
 import torch as t
 from utils.constants import Constants
 
@@ -12,6 +11,28 @@ def save_to_csv(dataframe: pd.DataFrame, name: str):
     dataframe.to_csv(f"data/saved/{name}.csv", index=False)
 
 
+def save_columns_to_csv(
+    columns: Dict[str, Union[pd.Series, str]], name: str, chunksize: int = 200_000
+):
+    """Writes `columns` (header -> Series, or a string repeated on every row) as a csv, chunk by chunk.
+    Only one chunk at a time is assembled into a new frame, the frames the Series come from are never copied."""
+    num_rows = max(
+        (len(column) for column in columns.values() if isinstance(column, pd.Series)),
+        default=0,
+    )
+    with open(f"data/saved/{name}.csv", "w") as file:
+        for start in range(0, max(num_rows, 1), chunksize):
+            chunk = pd.DataFrame(
+                {
+                    header: column
+                    if isinstance(column, str)
+                    else column.array[start : start + chunksize]
+                    for header, column in columns.items()
+                }
+            )
+            chunk.to_csv(file, index=False, header=start == 0)
+
+
 def save_to_neo4j(
     customers: pd.DataFrame,
     articles: pd.DataFrame,
@@ -22,69 +43,66 @@ def save_to_neo4j(
     extra_edge_type_label: Optional[str],
 ):
     print("| Saving to neo4j...")
+    # The csv columns are picked (and renamed) from the frames as they are and written
+    # in chunks, instead of copying every frame to add the neo4j specific columns
     print("| Processing customer nodes...")
-    customers = customers.copy()
-    customers[":LABEL"] = Constants.node_user
-    customers.rename(columns={"index": f":ID({Constants.node_user})"}, inplace=True)
-    customers["_id"] = customers[f":ID({Constants.node_user})"]
-    save_to_csv(customers, "customers")
+    save_columns_to_csv(node_columns(customers, Constants.node_user), "customers")
 
     print("| Processing article nodes...")
-    articles = articles.copy()
-    articles[":LABEL"] = Constants.node_item
-    articles.rename(columns={"index": f":ID({Constants.node_item})"}, inplace=True)
-    articles["_id"] = articles[f":ID({Constants.node_item})"]
-    save_to_csv(articles, "articles")
-
-    print("| Renaming transactions...")
-    transactions = transactions.copy()
-    transactions.rename(
-        columns={
-            f"{Constants.node_user}_id": f":START_ID({Constants.node_user})",
-            f"{Constants.node_item}_id": f":END_ID({Constants.node_item})",
-        },
-        inplace=True,
-    )
+    save_columns_to_csv(node_columns(articles, Constants.node_item), "articles")
 
     if extra_nodes is not None:
         print("| Processing extra nodes...")
-        extra_node_df = pd.DataFrame(data=extra_nodes.copy())
-        extra_node_df[":LABEL"] = extra_node_name
-        extra_node_df.rename(columns={"index": f":ID({extra_node_name})"}, inplace=True)
-        extra_node_df["_id"] = extra_node_df[f":ID({extra_node_name})"]
-        extra_node_df = extra_node_df.astype(str)
-        save_to_csv(extra_node_df, f"{extra_node_name}")
-        new_extra_edges = extra_edges.copy()
-        new_extra_edges.rename(
-            columns={
-                f"{Constants.node_item}_id": f":START_ID({Constants.node_item})",
-                f"{extra_node_name}_id": f":END_ID({extra_node_name})",
+        # string ids like the other extra node columns, the frame is one row per node
+        save_columns_to_csv(
+            node_columns(extra_nodes.astype(str), extra_node_name),
+            f"{extra_node_name}",
+        )
+        save_columns_to_csv(
+            {
+                f":START_ID({Constants.node_item})": extra_edges[
+                    f"{Constants.node_item}_id"
+                ].astype(int),
+                f":END_ID({extra_node_name})": extra_edges[
+                    f"{extra_node_name}_id"
+                ].astype(int),
+                ":TYPE": extra_edge_type_label,
             },
-            inplace=True,
+            "extra_transactions",
         )
-        new_extra_edges = new_extra_edges.astype(int)
-        new_extra_edges[":TYPE"] = extra_edge_type_label
-        save_to_csv(new_extra_edges, "extra_transactions")
-
-    transactions = drop_columns_if_exist(
-        transactions, ["t_dat", "price", "sales_channel_id", "year-month"]
-    )
 
-    transactions["train_mask"] = transactions["train_mask"].astype(int)
-    transactions["test_mask"] = transactions["test_mask"].astype(int)
-    transactions["val_mask"] = transactions["val_mask"].astype(int)
+    print("| Renaming transactions...")
+    renames = {
+        f"{Constants.node_user}_id": f":START_ID({Constants.node_user})",
+        f"{Constants.node_item}_id": f":END_ID({Constants.node_item})",
+    }
+    dropped = ["t_dat", "price", "sales_channel_id", "year-month"]
+    masks = ["train_mask", "test_mask", "val_mask"]
+    transaction_columns = {
+        renames.get(column, column): transactions[column].astype(np.int8)
+        if column in masks
+        else transactions[column]
+        for column in transactions.columns
+        if column not in dropped
+    }
 
     print("| Changing the edge names...")
-    transactions[":TYPE"] = transactions.apply(
-        lambda x: f"{Constants.rel_type}_TEST"
-        if x["test_mask"] == 1
-        else f"{Constants.rel_type}_VAL"
-        if x["val_mask"] == 1
-        else f"{Constants.rel_type}_TRAIN",
-        axis=1,
+    # a categorical keeps one byte per edge instead of one python string per edge
+    edge_types = np.select(
+        [transactions["test_mask"] == 1, transactions["val_mask"] == 1], [2, 1], 0
+    ).astype(np.int8)
+    transaction_columns[":TYPE"] = pd.Series(
+        pd.Categorical.from_codes(
+            edge_types,
+            [
+                f"{Constants.rel_type}_TRAIN",
+                f"{Constants.rel_type}_VAL",
+                f"{Constants.rel_type}_TEST",
+            ],
+        )
     )
 
-    save_to_csv(transactions, "transactions")
+    save_columns_to_csv(transaction_columns, "transactions")
     # Neo4j needs to be stopped for neo4j-admin import to run
     print("| Stopping running instances of Neo4j...")
     os.system("neo4j stop")
@@ -124,3 +142,18 @@ def save_to_neo4j(
     os.system(
         "echo 'MATCH (n) RETURN count(n)' | cypher-shell -u neo4j -p password --format plain"
     )
+
+
+def node_columns(
+    nodes: pd.DataFrame, node_name: str
+) -> Dict[str, Union[pd.Series, str]]:
+    """The csv columns of a node type for neo4j-admin import: the features, the id as both
+    `:ID(node_name)` and `_id`, and the label"""
+    id_column = f":ID({node_name})"
+    columns = {
+        id_column if column == "index" else column: nodes[column]
+        for column in nodes.columns
+    }
+    columns[":LABEL"] = node_name
+    columns["_id"] = columns[id_column]
+    return columns
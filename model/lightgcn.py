@@ -43,6 +43,9 @@ class LightGCN(MessagePassing):
         nn.init.normal_(self.users_emb.weight, std=0.1)
         nn.init.normal_(self.items_emb.weight, std=0.1)
 
+        # id(adjacency) -> (adjacency, \tilde{A}), see normalized_adjacency
+        self._normalized_adjacencies = dict()
+
     def forward(self, edge_index: SparseTensor):
         """Forward propagation of LightGCN Model.
 
@@ -53,7 +56,7 @@ class LightGCN(MessagePassing):
             tuple (Tensor): e_u_k, e_u_0, e_i_k, e_i_0
         """
         # compute \tilde{A}: symmetrically normalized adjacency matrix
-        edge_index_norm = gcn_norm(edge_index, add_self_loops=self.add_self_loops)
+        edge_index_norm = self.normalized_adjacency(edge_index)
 
         emb_0 = t.cat([self.users_emb.weight, self.items_emb.weight])  # E^0
         embs = [emb_0]
@@ -79,6 +82,20 @@ class LightGCN(MessagePassing):
             self.items_emb.weight,
         )
 
+    def normalized_adjacency(self, edge_index: SparseTensor) -> SparseTensor:
+        """The normalized adjacency only depends on the adjacency matrix, which is the same on every training step,
+        so it is computed once per adjacency instead of on every forward pass."""
+        cached = self._normalized_adjacencies.get(id(edge_index))
+        # the identity check guards against a new adjacency reusing the id of a freed one
+        if cached is None or cached[0] is not edge_index:
+            edge_index_norm = gcn_norm(edge_index, add_self_loops=self.add_self_loops)
+            # build the CSR row pointers and the transposed layout used by the backward
+            # pass now, while caching, instead of lazily inside the first training step
+            edge_index_norm.fill_cache_()
+            cached = (edge_index, edge_index_norm)
+            self._normalized_adjacencies[id(edge_index)] = cached
+        return cached[1]
+
     def message(self, x_j: Tensor) -> Tensor:
         return x_j
 
@@ -1,14 +1,16 @@
 import torch as t
 from torch import optim
 from tqdm import tqdm
-from torch_geometric.utils import structured_negative_sampling
 from model.lightgcn import LightGCN
-from data.lightgcn_loader import create_dataloaders_lightgcn, sample_mini_batch
+from data.lightgcn_loader import (
+    create_dataloaders_lightgcn,
+    sample_mini_batch,
+    positive_edge_keys,
+)
 from utils.metrics_lightgcn import (
     get_metrics_lightgcn,
     bpr_loss,
-    create_adj_dict,
-    make_predictions_for_user,
+    make_predictions_for_users,
 )
 from reporting.types import Stats
 
@@ -18,9 +20,18 @@ from config import LightGCNConfig, lightgcn_config
 
 # wrapper function to evaluate model
 def evaluation(
-    model, edge_index, sparse_edge_index, exclude_edge_indices, k, lambda_val
+    model,
+    edge_index,
+    sparse_edge_index,
+    exclude_edge_indices,
+    k,
+    lambda_val,
+    num_items,
+    positive_keys,
+    batch_size,
 ):
-    """Evaluates model loss and metrics including recall, precision, ndcg @ k
+    """Evaluates model loss and metrics including recall, precision, ndcg @ k.
+    The loss is estimated on `batch_size` sampled edges instead of negative sampling the whole split
 
     Args:
         model (LighGCN): lightgcn model
@@ -29,6 +40,9 @@ def evaluation(
         exclude_edge_indices ([type]): 2 by N list of edges for split to discount from evaluation
         k (int): determines the top k items to compute metrics on
         lambda_val (float): determines lambda for bpr loss
+        num_items (int): number of items, negatives are drawn from [0, num_items)
+        positive_keys (t.Tensor): positive_edge_keys(edge_index, num_items), built once per split
+        batch_size (int): number of edges the loss is computed on
 
     Returns:
         tuple: bpr loss, recall @ k, precision @ k, ndcg @ k
@@ -37,12 +51,9 @@ def evaluation(
     users_emb_final, users_emb_0, items_emb_final, items_emb_0 = model.forward(
         sparse_edge_index
     )
-    edges = structured_negative_sampling(
-        edge_index.to("cpu"),
-        num_nodes=t.max(edge_index[1]).to("cpu"),
-        contains_neg_self_loops=False,
+    user_indices, pos_item_indices, neg_item_indices = sample_mini_batch(
+        batch_size, edge_index, num_items=num_items, positive_keys=positive_keys
     )
-    user_indices, pos_item_indices, neg_item_indices = edges[0], edges[1], edges[2]
     users_emb_final, users_emb_0 = (
         users_emb_final[user_indices],
         users_emb_0[user_indices],
@@ -110,6 +121,10 @@ def train(config: LightGCNConfig):
     val_edge_index = val_edge_index.to(device)
     val_sparse_edge_index = val_sparse_edge_index.to(device)
 
+    # the train edges don't change, so the keys for negative sampling are built once, on the device
+    train_positive_keys = positive_edge_keys(train_edge_index, num_articles)
+    val_positive_keys = positive_edge_keys(val_edge_index, num_articles)
+
     # training loop
     train_losses = []
     val_losses = []
@@ -123,12 +138,10 @@ def train(config: LightGCNConfig):
 
         # mini batching
         user_indices, pos_item_indices, neg_item_indices = sample_mini_batch(
-            config.batch_size, train_edge_index
-        )
-        user_indices, pos_item_indices, neg_item_indices = (
-            user_indices.to(device),
-            pos_item_indices.to(device),
-            neg_item_indices.to(device),
+            config.batch_size,
+            train_edge_index,
+            num_items=num_articles,
+            positive_keys=train_positive_keys,
         )
         users_emb_final, users_emb_0 = (
             users_emb_final[user_indices],
@@ -160,6 +173,7 @@ def train(config: LightGCNConfig):
 
         if iter % config.eval_every == 0:
             model.eval()
+            train_loss_value = train_loss.item()
             val_loss, recall, precision, ndcg = evaluation(
                 model,
                 val_edge_index,
@@ -167,11 +181,14 @@ def train(config: LightGCNConfig):
                 [train_edge_index],
                 config.k,
                 config.Lambda,
+                num_articles,
+                val_positive_keys,
+                config.eval_batch_size,
             )
             print(
-                f"[Iter {iter}/{config.epochs}] train_loss: {round(train_loss.item(), 5)}, val_loss: {round(val_loss, 5)}, val_recall@{config.k}: {round(recall, 6)}, val_precision@{config.k}: {round(precision, 6)}, val_ndcg@{config.k}: {round(ndcg, 6)}"
+                f"[Iter {iter}/{config.epochs}] train_loss: {round(train_loss_value, 5)}, val_loss: {round(val_loss, 5)}, val_recall@{config.k}: {round(recall, 6)}, val_precision@{config.k}: {round(precision, 6)}, val_ndcg@{config.k}: {round(ndcg, 6)}"
             )
-            train_losses.append(train_loss.item())
+            train_losses.append(train_loss_value)
             val_losses.append(val_loss)
             model.train()
 
@@ -201,6 +218,9 @@ def train(config: LightGCNConfig):
         [train_edge_index, val_edge_index],
         config.k,
         config.Lambda,
+        num_articles,
+        positive_edge_keys(test_edge_index, num_articles),
+        config.eval_batch_size,
     )
 
     print(
@@ -209,17 +229,15 @@ def train(config: LightGCNConfig):
 
     # Save predictions for the matcher
     model.eval()
-    pos_items_per_user = create_adj_dict(edge_index)
-    top_items_per_user = {}
-    for user in tqdm(range(0, num_users)):
-        top_items_per_user[user] = make_predictions_for_user(
-            model.users_emb.weight,
-            model.items_emb.weight,
-            user,
-            pos_items_per_user,
-            config.num_recommendations,
-        )
-    t.save(top_items_per_user, "data/derived/lightgcn_output.pt")
+    top_items = make_predictions_for_users(
+        model.users_emb.weight,
+        model.items_emb.weight,
+        t.arange(num_users, device=device),
+        edge_index,
+        config.num_recommendations,
+    ).cpu()
+    # A single [num_users, num_recommendations] tensor, row i holds the items of user i
+    t.save(top_items, "data/derived/lightgcn_output.pt")
 
     save_scores(model)
 
@@ -1,22 +1,24 @@
 import pandas as pd
-from tqdm import tqdm
 from data.types import (
     DataType,
     BasePreprocessingConfig,
 )
 import torch as t
-import json
 import re
 from run_data_splitting import train_test_split_by_time
-from utils.labelencoder import encode_labels
+from utils.labelencoder import encode_label_columns
 from config import preprocessing_config
 from typing import List
 from utils.preprocessing import (
     create_data_pyg,
     create_data_dgl,
     create_ids_and_maps,
-    extract_edges,
-    extract_reverse_edges,
+    map_ids,
+    nested_splits,
+    group_to_dict,
+    save_splits,
+    save_json,
+    frame_to_long_tensor,
 )
 from data.neo4j.save import save_to_neo4j
 
@@ -64,30 +66,28 @@ def preprocess(config: BasePreprocessingConfig):
         transactions = transactions[: config.data_size]
 
     print("| Encoding article features...")
-    for column in tqdm(articles.columns):
-        if column != "article_id":
-            articles[column] = encode_labels(articles[column])
+    articles = encode_label_columns(
+        articles, [c for c in articles.columns if c != "article_id"]
+    )
 
     print("| Encoding customer features...")
-    for column in tqdm(customers.columns):
-        if column != "customer_id":
-            customers[column] = encode_labels(customers[column])
+    customers = encode_label_columns(
+        customers, [c for c in customers.columns if c != "customer_id"]
+    )
 
     if config.filter_out_unconnected_nodes:
         print("| Removing unconnected nodes...")
-        all_article_ids_referenced = set(transactions["article_id"].unique())
-        all_customer_ids_referenced = set(transactions["customer_id"].unique())
-        disjoint_customers = set(customers["customer_id"].unique()).difference(
-            all_customer_ids_referenced
+        connected_customers = customers["customer_id"].isin(
+            transactions["customer_id"].unique()
         )
-        print("|     Removing {} customers...".format(len(disjoint_customers)))
-        disjoint_articles = set(articles["article_id"].unique()).difference(
-            all_article_ids_referenced
+        print("|     Removing {} customers...".format((~connected_customers).sum()))
+        connected_articles = articles["article_id"].isin(
+            transactions["article_id"].unique()
         )
-        print("|     Removing {} articles...".format(len(disjoint_articles)))
+        print("|     Removing {} articles...".format((~connected_articles).sum()))
 
-        customers = customers[~customers["customer_id"].isin(disjoint_customers)]
-        articles = articles[~articles["article_id"].isin(disjoint_articles)]
+        customers = customers[connected_customers]
+        articles = articles[connected_articles]
 
     customers, customer_id_map_forward, customer_id_map_reverse = create_ids_and_maps(
         customers, "customer_id", 0
@@ -99,11 +99,11 @@ def preprocess(config: BasePreprocessingConfig):
     )
 
     print("| Parsing transactions...")
-    transactions["article_id"] = transactions["article_id"].apply(
-        lambda x: article_id_map_reverse[x]
+    transactions["article_id"] = map_ids(
+        transactions["article_id"], article_id_map_reverse
     )
-    transactions["customer_id"] = transactions["customer_id"].apply(
-        lambda x: customer_id_map_reverse[x]
+    transactions["customer_id"] = map_ids(
+        transactions["customer_id"], customer_id_map_reverse
     )
 
     print(
@@ -112,12 +112,8 @@ def preprocess(config: BasePreprocessingConfig):
     transactions = transactions.sort_values("timestamp")
     transactions = train_test_split_by_time(transactions, "customer_id")
 
-    transactions_train = transactions[transactions["train_mask"] == True]
-    transactions_val = pd.concat(
-        [transactions_train, transactions[transactions["val_mask"] == True]], axis=0
-    )
-    transactions_test = pd.concat(
-        [transactions_val, transactions[transactions["test_mask"] == True]], axis=0
+    transactions_train, transactions_val, transactions_test = nested_splits(
+        transactions
     )
 
     print("| Removing unused columns...")
@@ -128,10 +124,10 @@ def preprocess(config: BasePreprocessingConfig):
         save_to_neo4j(customers, articles, transactions)
 
     print("| Converting to tensors...")
-    customers = t.tensor(customers.to_numpy(), dtype=t.long)
+    customers = frame_to_long_tensor(customers)
     assert t.isnan(customers).any() == False
 
-    articles = t.tensor(articles.to_numpy(), dtype=t.long)
+    articles = frame_to_long_tensor(articles)
     assert t.isnan(articles).any() == False
 
     print("| Creating Data...")
@@ -173,30 +169,23 @@ def preprocess(config: BasePreprocessingConfig):
         None,
     )
 
-    print("| Saving the graph...")
-    t.save(train_graph, "data/derived/train_graph.pt")
-    t.save(val_graph, "data/derived/val_graph.pt")
-    t.save(test_graph, "data/derived/test_graph.pt")
-
-    print("| Extracting edges per customer / per article...")
-    t.save(extract_edges(transactions_train), "data/derived/edges_train.pt")
-    t.save(extract_reverse_edges(transactions_train), "data/derived/rev_edges_train.pt")
-
-    t.save(extract_edges(transactions_val), "data/derived/edges_val.pt")
-    t.save(extract_reverse_edges(transactions_val), "data/derived/rev_edges_val.pt")
-
-    t.save(extract_edges(transactions_test), "data/derived/edges_test.pt")
-    t.save(extract_reverse_edges(transactions_test), "data/derived/rev_edges_test.pt")
+    print("| Saving the graph and the edges per customer / per article...")
+    save_splits(
+        dict(train=train_graph, val=val_graph, test=test_graph),
+        dict(train=transactions_train, val=transactions_val, test=transactions_test),
+        customers.shape[0],
+        articles.shape[0],
+    )
 
     print("| Saving the node-to-id mapping...")
-    with open("data/derived/customer_id_map_forward.json", "w") as fp:
-        json.dump(customer_id_map_forward, fp)
-    with open("data/derived/article_id_map_forward.json", "w") as fp:
-        json.dump(article_id_map_forward, fp)
+    save_json(customer_id_map_forward, "data/derived/customer_id_map_forward.json")
+    save_json(article_id_map_forward, "data/derived/article_id_map_forward.json")
 
 
 def extract_users_per_location(customers: pd.DataFrame) -> dict:
-    return customers.groupby("postal_code")["index"].apply(list).to_dict()
+    return group_to_dict(
+        customers["postal_code"].to_numpy(), customers["index"].to_numpy()
+    )
 
 
 def extract_location_for_user(customers: pd.DataFrame) -> dict:
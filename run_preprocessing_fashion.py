@@ -1,19 +1,27 @@
 import pandas as pd
-from tqdm import tqdm
+import numpy as np
 from data.types import (
+    ArticleColumn,
     DataType,
     PreprocessingConfig,
 )
 import torch as t
-import json
-from utils.labelencoder import encode_labels
+from functools import partial
+from typing import Tuple
+from utils.labelencoder import encode_label_columns
 from config import preprocessing_config
 from utils.preprocessing import (
     create_data_pyg,
     create_data_dgl,
     create_ids_and_maps,
-    extract_edges,
-    extract_reverse_edges,
+    map_ids,
+    nested_splits,
+    group_to_dict,
+    save_splits,
+    save_json,
+    frame_to_long_tensor,
+    read_parquet,
+    read_cached_frames,
 )
 from utils.constants import Constants
 from data.neo4j.save import save_to_neo4j
@@ -21,58 +29,36 @@ from data.neo4j.save import save_to_neo4j
 
 def preprocess(config: PreprocessingConfig):
     config.print()
-    print("| Loading customers...")
-    customers = pd.read_parquet("data/original/customers.parquet").fillna(0.0)
-    customers = customers[[c.value for c in config.customer_features] + ["customer_id"]]
-
-    print("| Loading articles...")
-    articles = pd.read_parquet("data/original/articles.parquet").fillna(0.0)
-
-    print("| Loading transactions...")
-    transactions = pd.read_parquet("data/original/transactions_splitted.parquet")
-    if config.data_size is not None:
-        transactions = transactions[: config.data_size]
-
-    transactions["year-month"] = pd.to_datetime(transactions["t_dat"]).dt.strftime(
-        "%Y-%m"
+    # re-runs on unchanged inputs read the encoded frames back from an Arrow IPC checkpoint
+    customers, articles, transactions = read_cached_frames(
+        ["customers", "articles", "transactions"],
+        dict(
+            customer_features=config.customer_features,
+            article_features=config.article_features,
+            article_non_categorical_features=config.article_non_categorical_features,
+            data_size=config.data_size,
+        ),
+        [
+            "data/original/customers.parquet",
+            "data/original/articles.parquet",
+            "data/original/transactions_splitted.parquet",
+        ],
+        partial(load_encoded_frames, config),
     )
 
-    print("| Calculating average price per product...")
-    transactions_per_article = transactions.groupby(["article_id"]).mean()["price"]
-    articles = articles.merge(
-        transactions_per_article, on="article_id", how="outer"
-    ).fillna(0.0)
-
-    articles = articles[[c.value for c in config.article_features] + ["article_id"]]
-
-    print("| Encoding article features...")
-    for column in tqdm(articles.columns):
-        if (
-            column not in config.article_non_categorical_features
-            and column != "article_id"
-        ):
-            articles[column] = encode_labels(articles[column])
-
-    print("| Encoding customer features...")
-    for column in tqdm(customers.columns):
-        if column != "customer_id":
-            customers[column] = encode_labels(customers[column])
-
     if config.filter_out_unconnected_nodes:
         print("| Removing unconnected nodes...")
-        all_article_ids_referenced = set(transactions["article_id"].unique())
-        all_customer_ids_referenced = set(transactions["customer_id"].unique())
-        disjoint_customers = set(customers["customer_id"].unique()).difference(
-            all_customer_ids_referenced
+        connected_customers = customers["customer_id"].isin(
+            transactions["customer_id"].unique()
         )
-        print("|     Removing {} customers...".format(len(disjoint_customers)))
-        disjoint_articles = set(articles["article_id"].unique()).difference(
-            all_article_ids_referenced
+        print("|     Removing {} customers...".format((~connected_customers).sum()))
+        connected_articles = articles["article_id"].isin(
+            transactions["article_id"].unique()
         )
-        print("|     Removing {} articles...".format(len(disjoint_articles)))
+        print("|     Removing {} articles...".format((~connected_articles).sum()))
 
-        customers = customers[~customers["customer_id"].isin(disjoint_customers)]
-        articles = articles[~articles["article_id"].isin(disjoint_articles)]
+        customers = customers[connected_customers]
+        articles = articles[connected_articles]
 
     customers, customer_id_map_forward, customer_id_map_reverse = create_ids_and_maps(
         customers, "customer_id", 0
@@ -101,65 +87,29 @@ def preprocess(config: PreprocessingConfig):
             0,
         )
         extra_edges = articles[["article_id", Constants.node_extra]]
-        extra_edges[Constants.node_extra] = extra_edges[Constants.node_extra].apply(
-            lambda x: extra_nodes_id_map_reverse[x]
+        extra_edges[Constants.node_extra] = map_ids(
+            extra_edges[Constants.node_extra], extra_nodes_id_map_reverse
         )
-        extra_edges["article_id"] = extra_edges["article_id"].apply(
-            lambda x: article_id_map_reverse[x]
+        extra_edges["article_id"] = map_ids(
+            extra_edges["article_id"], article_id_map_reverse
         )
         extra_edges.rename(
             columns={Constants.node_extra: f"{Constants.node_extra}_id"}, inplace=True
         )
 
     print("| Parsing transactions...")
-    transactions["article_id"] = transactions["article_id"].apply(
-        lambda x: article_id_map_reverse[x]
-    )
-    transactions["customer_id"] = transactions["customer_id"].apply(
-        lambda x: customer_id_map_reverse[x]
+    transactions["article_id"] = map_ids(
+        transactions["article_id"], article_id_map_reverse
     )
-    transactions_train = transactions[transactions["train_mask"] == True]
-    transactions_val = pd.concat(
-        [transactions_train, transactions[transactions["val_mask"] == True]], axis=0
+    transactions["customer_id"] = map_ids(
+        transactions["customer_id"], customer_id_map_reverse
     )
-    transactions_test = pd.concat(
-        [transactions_val, transactions[transactions["test_mask"] == True]], axis=0
+    transactions_train, transactions_val, transactions_test = nested_splits(
+        transactions
     )
 
-    per_article_img_embedding = t.zeros((0, 512))
-    if config.load_image_embedding:
-        print("| Adding image embeddings...")
-        image_embeddings = t.load(
-            "data/derived/fashion-recommendation-image-embeddings-clip-ViT-B-32.pt"
-        )
-        for index, article in tqdm(articles.iterrows()):
-            per_article_img_embedding = t.cat(
-                (
-                    per_article_img_embedding,
-                    image_embeddings.get(
-                        int(article["article_id"]), t.zeros(512)
-                    ).unsqueeze(0),
-                ),
-                axis=0,
-            )
-
-    per_article_text_embedding = t.zeros((0, 512))
-    if config.load_text_embedding:
-        print("| Adding text embeddings...")
-        text_embeddings = t.load(
-            "data/derived/fashion-recommendation-text-embeddings-clip-ViT-B-32.pt"
-        )
-
-        for index, article in tqdm(articles.iterrows()):
-            per_article_text_embedding = t.cat(
-                (
-                    per_article_text_embedding,
-                    text_embeddings[int(article["article_id"])]
-                    .get(config.text_embedding_colname, t.zeros(512))
-                    .unsqueeze(0),
-                ),
-                axis=0,
-            )
+    # the embeddings are looked up by the original ids, article_id is dropped further down
+    article_ids = articles["article_id"].to_numpy().astype(int)
 
     print("| Exporting per location info...")
     t.save(
@@ -171,9 +121,16 @@ def preprocess(config: PreprocessingConfig):
     print("last day:", transactions.tail(1)["t_dat"].item())
     last_month = transactions.tail(1)["year-month"].item()
     last_month_transactions = transactions[transactions["year-month"] == last_month]
-    most_popular_products = (
-        last_month_transactions["article_id"].value_counts().nlargest(1000)
+    ids, counts = np.unique(
+        last_month_transactions["article_id"].to_numpy(), return_counts=True
     )
+    # argpartition needs a valid kth, with up to 1000 products (or none) all of them are kept
+    if len(counts) > 1000:
+        top = np.argpartition(-counts, 999)[:1000]
+    else:
+        top = np.arange(len(counts))
+    top = top[np.argsort(-counts[top], kind="stable")]
+    most_popular_products = pd.Series(counts[top], index=ids[top], name="article_id")
     t.save(most_popular_products, "data/derived/most_popular_products.pt")
 
     print("| Removing unused columns...")
@@ -194,20 +151,59 @@ def preprocess(config: PreprocessingConfig):
         )
 
     print("| Converting to tensors...")
-    customers = t.tensor(customers.to_numpy(), dtype=t.long)
+    customers = frame_to_long_tensor(customers)
     assert t.isnan(customers).any() == False
 
-    articles = t.tensor(articles.to_numpy(), dtype=t.long)
-    if config.load_image_embedding:
-        articles = t.cat((articles, per_article_img_embedding), axis=1)
-    if config.load_text_embedding:
-        articles = t.cat((articles, per_article_text_embedding), axis=1)
+    num_embeddings = int(config.load_image_embedding) + int(config.load_text_embedding)
+    if num_embeddings == 0:
+        articles = frame_to_long_tensor(articles)
+    else:
+        # allocated once at full width, the embeddings go in the columns after the features
+        column = articles.shape[1]
+        article_features = t.empty((len(articles), column + num_embeddings * 512))
+        frame_to_long_tensor(articles, out=article_features)
+        no_embedding = t.zeros(512)
+        ids = article_ids.tolist()
+
+        if config.load_image_embedding:
+            print("| Adding image embeddings...")
+            image_embeddings = t.load(
+                "data/derived/fashion-recommendation-image-embeddings-clip-ViT-B-32.pt"
+            )
+            article_features[:, column : column + 512] = t.stack(
+                [image_embeddings.get(article_id, no_embedding) for article_id in ids]
+            )
+            column += 512
+
+        if config.load_text_embedding:
+            print("| Adding text embeddings...")
+            text_embeddings = t.load(
+                "data/derived/fashion-recommendation-text-embeddings-clip-ViT-B-32.pt"
+            )
+            article_features[:, column : column + 512] = t.stack(
+                [
+                    text_embeddings[article_id].get(
+                        config.text_embedding_colname, no_embedding
+                    )
+                    for article_id in ids
+                ]
+            )
+            column += 512
+
+        articles = article_features
     assert t.isnan(articles).any() == False
 
     if Constants.node_extra is not None:
-        extra_nodes = t.tensor(extra_nodes.to_numpy(), dtype=t.long)
+        extra_nodes = frame_to_long_tensor(extra_nodes)
 
     print("| Creating Data...")
+    # the splits are prefixes of each other: widen the ids to long once and slice them
+    edge_customers = t.from_numpy(transactions_test["customer_id"].to_numpy()).long()
+    edge_articles = t.from_numpy(transactions_test["article_id"].to_numpy()).long()
+    train_end, val_end, test_end = (
+        len(split) for split in (transactions_train, transactions_val, transactions_test)
+    )
+
     # If we ever want to get dgl data creation back
     # create_func = (
     #     create_data_dgl if config.data_type == DataType.dgl else create_data_pyg
@@ -217,8 +213,8 @@ def preprocess(config: PreprocessingConfig):
         articles,
         extra_nodes,
         Constants.node_extra if Constants.node_extra is not None else None,
-        transactions_train["customer_id"].to_numpy(),
-        transactions_train["article_id"].to_numpy(),
+        edge_customers[:train_end],
+        edge_articles[:train_end],
         extra_edges["article_id"].to_numpy() if extra_edges is not None else None,
         extra_edges[f"{Constants.node_extra}_id"].to_numpy()
         if extra_edges is not None
@@ -230,8 +226,8 @@ def preprocess(config: PreprocessingConfig):
         articles,
         extra_nodes,
         Constants.node_extra if Constants.node_extra is not None else None,
-        transactions_val["customer_id"].to_numpy(),
-        transactions_val["article_id"].to_numpy(),
+        edge_customers[:val_end],
+        edge_articles[:val_end],
         extra_edges["article_id"].to_numpy() if extra_edges is not None else None,
         extra_edges[f"{Constants.node_extra}_id"].to_numpy()
         if extra_edges is not None
@@ -243,8 +239,8 @@ def preprocess(config: PreprocessingConfig):
         articles,
         extra_nodes,
         Constants.node_extra if Constants.node_extra is not None else None,
-        transactions_test["customer_id"].to_numpy(),
-        transactions_test["article_id"].to_numpy(),
+        edge_customers[:test_end],
+        edge_articles[:test_end],
         extra_edges["article_id"].to_numpy() if extra_edges is not None else None,
         extra_edges[f"{Constants.node_extra}_id"].to_numpy()
         if extra_edges is not None
@@ -252,30 +248,84 @@ def preprocess(config: PreprocessingConfig):
         Constants.edge_key_extra,
     )
 
-    print("| Saving the graph...")
-    t.save(train_graph, "data/derived/train_graph.pt")
-    t.save(val_graph, "data/derived/val_graph.pt")
-    t.save(test_graph, "data/derived/test_graph.pt")
+    print("| Saving the graph and the edges per customer / per article...")
+    save_splits(
+        dict(train=train_graph, val=val_graph, test=test_graph),
+        dict(train=transactions_train, val=transactions_val, test=transactions_test),
+        customers.shape[0],
+        articles.shape[0],
+    )
 
-    print("| Extracting edges per customer / per article...")
-    t.save(extract_edges(transactions_train), "data/derived/edges_train.pt")
-    t.save(extract_reverse_edges(transactions_train), "data/derived/rev_edges_train.pt")
+    print("| Saving the node-to-id mapping...")
+    save_json(customer_id_map_forward, "data/derived/customer_id_map_forward.json")
+    save_json(article_id_map_forward, "data/derived/article_id_map_forward.json")
+
+
+def load_encoded_frames(
+    config: PreprocessingConfig,
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    print("| Loading customers...")
+    customers = read_parquet(
+        "data/original/customers.parquet",
+        [c.value for c in config.customer_features] + ["customer_id"],
+    ).fillna(0.0)
+    customers = customers[[c.value for c in config.customer_features] + ["customer_id"]]
 
-    t.save(extract_edges(transactions_val), "data/derived/edges_val.pt")
-    t.save(extract_reverse_edges(transactions_val), "data/derived/rev_edges_val.pt")
+    print("| Loading articles...")
+    articles = read_parquet(
+        "data/original/articles.parquet",
+        [c.value for c in config.article_features] + ["article_id"],
+    ).fillna(0.0)
 
-    t.save(extract_edges(transactions_test), "data/derived/edges_test.pt")
-    t.save(extract_reverse_edges(transactions_test), "data/derived/rev_edges_test.pt")
+    print("| Loading transactions...")
+    transactions = read_parquet(
+        "data/original/transactions_splitted.parquet",
+        [
+            "t_dat",
+            "customer_id",
+            "article_id",
+            "price",
+            "train_mask",
+            "val_mask",
+            "test_mask",
+        ],
+        num_rows=config.data_size,
+    )
 
-    print("| Saving the node-to-id mapping...")
-    with open("data/derived/customer_id_map_forward.json", "w") as fp:
-        json.dump(customer_id_map_forward, fp)
-    with open("data/derived/article_id_map_forward.json", "w") as fp:
-        json.dump(article_id_map_forward, fp)
+    # months as integers (year * 12 + month) instead of a "%Y-%m" python string per row
+    dates = pd.to_datetime(transactions["t_dat"])
+    transactions["year-month"] = (dates.dt.year * 12 + dates.dt.month).astype(np.int32)
+
+    print("| Calculating average price per product...")
+    average_price = transactions.groupby("article_id", sort=False)["price"].mean()
+    articles[ArticleColumn.AvgPrice.value] = (
+        articles["article_id"].map(average_price).fillna(0.0)
+    )
+
+    articles = articles[[c.value for c in config.article_features] + ["article_id"]]
+
+    print("| Encoding article features...")
+    articles = encode_label_columns(
+        articles,
+        [
+            c
+            for c in articles.columns
+            if c not in config.article_non_categorical_features and c != "article_id"
+        ],
+    )
+
+    print("| Encoding customer features...")
+    customers = encode_label_columns(
+        customers, [c for c in customers.columns if c != "customer_id"]
+    )
+
+    return customers, articles, transactions
 
 
 def extract_users_per_location(customers: pd.DataFrame) -> dict:
-    return customers.groupby("postal_code")["index"].apply(list).to_dict()
+    return group_to_dict(
+        customers["postal_code"].to_numpy(), customers["index"].to_numpy()
+    )
 
 
 def extract_location_for_user(customers: pd.DataFrame) -> dict:
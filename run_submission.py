@@ -27,20 +27,26 @@ def load_dataloaders(config: Config):
     return test_loader, customer_id_map, article_id_map
 
 
+def __id_lookup(id_map: dict) -> np.ndarray:
+    """Turns a {"position": id} map (keys are strings in the json) into an array indexed by position,
+    built once so every prediction is mapped with a single array gather"""
+    positions = np.fromiter(map(int, id_map.keys()), dtype=np.int64, count=len(id_map))
+    lookup = np.empty(positions.max() + 1, dtype=object)
+    lookup[positions] = list(id_map.values())
+    return lookup
+
+
 def map_to_id(
     predictions: Tensor, customer_id_map: dict, article_id_map: dict
 ) -> pd.DataFrame:
-    df = pd.DataFrame(predictions.numpy())
-
-    for col in df.columns:
-        df[col] = df[col].map(str).map(article_id_map)
-
-    df["customer_id"] = df.index.to_series().map(lambda x: customer_id_map[str(x)])
-    df["prediction"] = (
-        df[[column for column in df.columns if column != "customer_id"]]
-        .astype(str)
-        .agg(" ".join, axis=1)
-    )
+    df = pd.DataFrame(__id_lookup(article_id_map)[predictions.numpy()])
+
+    df["customer_id"] = __id_lookup(customer_id_map)[df.index.to_numpy()]
+    # column-wise str.cat instead of a python " ".join per row
+    prediction_columns = [
+        df[column].astype(str) for column in df.columns if column != "customer_id"
+    ]
+    df["prediction"] = prediction_columns[0].str.cat(prediction_columns[1:], sep=" ")
 
     return df
 
@@ -0,0 +1,42 @@
+import torch as t
+from data.lightgcn_loader import positive_edge_keys, sample_mini_batch
+from utils.metrics_lightgcn import make_predictions_for_users
+
+# user -> item edges, every user keeps at least one negative item
+edge_index = t.tensor([[0, 0, 0, 1, 2, 2, 3], [0, 1, 2, 3, 0, 4, 1]])
+num_items = 5
+
+
+def test_sample_mini_batch():
+    t.manual_seed(0)
+    positives = set(map(tuple, edge_index.t().tolist()))
+    users, positive_items, negative_items = sample_mini_batch(
+        256,
+        edge_index,
+        num_items=num_items,
+        positive_keys=positive_edge_keys(edge_index, num_items),
+    )
+    assert len(users) == len(positive_items) == len(negative_items) == 256
+    for user, positive, negative in zip(
+        users.tolist(), positive_items.tolist(), negative_items.tolist()
+    ):
+        assert (user, positive) in positives
+        assert (user, negative) not in positives
+        assert 0 <= negative < num_items
+
+
+def test_make_predictions_for_users():
+    t.manual_seed(0)
+    user_embeddings = t.randn(4, 8, dtype=t.float64)
+    article_embeddings = t.randn(num_items, 8, dtype=t.float64)
+    users = t.tensor([3, 0, 2])
+
+    # a batch size smaller than the number of users, the excluded edges span batches
+    predictions = make_predictions_for_users(
+        user_embeddings, article_embeddings, users, edge_index, 2, batch_size=2
+    )
+
+    for row, user in enumerate(users.tolist()):
+        scores = user_embeddings[user] @ article_embeddings.T
+        scores[edge_index[1][edge_index[0] == user]] = -float("inf")
+        assert t.equal(predictions[row], t.topk(scores, k=2).indices)
@@ -0,0 +1,116 @@
+import os
+import numpy as np
+import pandas as pd
+import torch as t
+from data.dataset import fetch_n_hop_neighbourhood
+from data.n_hop_numba import fetch_n_hop_neighbourhood_numba
+from utils.preprocessing import group_to_dict, save_adjacency
+from utils.tensor import (
+    adjacency_to_csr,
+    csr_edges,
+    csr_neighbours,
+    load_csr,
+    remap_to_positions,
+    unique_unsorted,
+)
+
+# user -> articles, users 2 and 4 have no edges
+keys = np.array([3, 0, 3, 1, 0, 3])
+values = np.array([2, 1, 1, 0, 3, 3])
+adjacency = {0: [1, 3], 1: [0], 3: [2, 1, 3]}
+num_users = 5
+
+
+def test_group_to_dict():
+    assert group_to_dict(keys, values) == adjacency
+    expected = pd.DataFrame(dict(k=keys, v=values)).groupby("k")["v"].apply(list)
+    assert group_to_dict(keys, values) == expected.to_dict()
+    assert group_to_dict(np.array([]), np.array([])) == dict()
+
+
+def test_csr_neighbours():
+    indptr, indices = adjacency_to_csr(adjacency, num_users)
+    for node in range(num_users):
+        assert csr_neighbours(indptr, indices, node).tolist() == adjacency.get(node, [])
+
+
+def test_csr_edges():
+    indptr, indices = adjacency_to_csr(adjacency, num_users)
+    node_ids = t.tensor([3, 2, 0])
+    edges = csr_edges(indptr, indices, node_ids)
+    assert edges.t().tolist() == [
+        [node, neighbour]
+        for node in node_ids.tolist()
+        for neighbour in adjacency.get(node, [])
+    ]
+
+
+def test_save_adjacency_writes_matching_csr(tmp_path):
+    path = str(tmp_path / "edges.pt")
+    save_adjacency(keys, values, num_users, path)
+    assert t.load(path) == adjacency
+
+    indptr, indices = load_csr(path)
+    expected_indptr, expected_indices = adjacency_to_csr(adjacency, num_users)
+    assert t.equal(indptr, expected_indptr)
+    assert t.equal(indices.long(), expected_indices)
+
+    # binaries older than the dict are left over from an earlier run
+    mtime = os.path.getmtime(path)
+    os.utime(path, (mtime + 10, mtime + 10))
+    assert load_csr(path) is None
+
+
+def test_unique_unsorted():
+    values = t.tensor([4, 1, 4, 2, 1])
+    scratch = t.empty(5, dtype=t.long)
+    assert sorted(unique_unsorted(values, scratch).tolist()) == [1, 2, 4]
+
+
+def test_remap_to_positions():
+    buckets = t.tensor([2, 5, 9])
+    values = t.tensor([9, 2, 5, 9])
+    assert remap_to_positions(values, buckets).tolist() == [2, 0, 1, 2]
+    assert t.equal(remap_to_positions(values, buckets), t.bucketize(values, buckets))
+
+
+def test_n_hop_numba_matches_torch():
+    rng = np.random.default_rng(0)
+    num_users, num_articles = 20, 15
+    pairs = np.unique(
+        np.stack(
+            [rng.integers(0, num_users, 60), rng.integers(0, num_articles, 60)]
+        ),
+        axis=1,
+    )
+    users_csr = adjacency_to_csr(group_to_dict(pairs[0], pairs[1]), num_users)
+    articles_csr = adjacency_to_csr(group_to_dict(pairs[1], pairs[0]), num_articles)
+    users_visited = t.zeros(num_users, dtype=t.bool)
+    users_scratch = t.empty(num_users, dtype=t.long)
+
+    # more neighbours than any node has: nothing is sampled, both return the same edges
+    for user_id in range(num_users):
+        n_hop_edges = fetch_n_hop_neighbourhood(
+            3,
+            user_id,
+            users_csr,
+            articles_csr,
+            num_neighbors=100,
+            users_visited=users_visited,
+            users_scratch=users_scratch,
+        )
+        assert not users_visited.any()
+        n_hop_edges_numba = fetch_n_hop_neighbourhood_numba(
+            3,
+            user_id,
+            users_csr,
+            articles_csr,
+            num_neighbors=100,
+            users_visited=users_visited,
+        )
+        assert not users_visited.any()
+        assert sorted(n_hop_edges.t().tolist()) == sorted(
+            n_hop_edges_numba.t().tolist()
+        )
+        # the direct edges of the user are never part of the neighbourhood
+        assert (n_hop_edges[0] != user_id).all()
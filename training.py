@@ -71,8 +71,8 @@ def train_with_dataloader(
     train_loop = tqdm(iter(data_loader), colour="blue")
     for i, data in enumerate(train_loop):
         train_loop.set_description(f"TRAIN | epoch: {epoch}")
-        loss = __train(data.to(device), model, optimizer)
-        losses.append(loss.detach().cpu().item())
+        loss = __train(data.to(device, non_blocking=True), model, optimizer)
+        losses.append(loss.item())
         train_loop.set_postfix_str(f"Loss: {np.mean(losses):.4f}")
 
     return losses
@@ -96,7 +96,9 @@ def test_with_dataloader(
         if break_at and i == break_at:
             break
         loop.set_description(f"{mode}")
-        recall, precision = __test(data.to(device), model, [], k=k)
+        recall, precision = __test(
+            data.to(device, non_blocking=True), model, [], k=k
+        )
         recalls.append(recall)
         precisions.append(precision)
         loop.set_postfix_str(
@@ -0,0 +1,27 @@
+import os
+import inspect
+import torch as t
+from functools import lru_cache
+from typing import Any
+
+# t.load(mmap=True) arrived in PyTorch 2.1, environment.yml still pins 1.10
+__supports_mmap = "mmap" in inspect.signature(t.load).parameters
+
+
+def load_cached(path: str) -> Any:
+    """t.load that reads each file only once per process (until it is rewritten).
+    The returned object is shared between callers, so it must not be mutated."""
+    return __load(path, os.path.getmtime(path))
+
+
+def load_mmap(path: str) -> Any:
+    """t.load that memory-maps the tensor storages when the installed torch supports it,
+    so forked workers share the pages through the OS page cache instead of holding a copy each"""
+    if __supports_mmap:
+        return t.load(path, mmap=True, map_location="cpu")
+    return t.load(path)
+
+
+@lru_cache(maxsize=None)
+def __load(path: str, mtime: float) -> Any:
+    return load_mmap(path)
@@ -1,6 +1,15 @@
 import pandas as pd
+from typing import List
 
 
 def encode_labels(series: pd.Series) -> pd.Series:
     """A sped up version of scikit-learn's LabelEncoder that only works on pandas Series"""
     return series.astype("category").cat.codes
+
+
+def encode_label_columns(df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    """Runs encode_labels over `columns` and writes them back with a single assignment,
+    instead of replacing (and re-consolidating) the frame's blocks one column at a time"""
+    if len(columns) > 0:
+        df[columns] = df[columns].apply(encode_labels)
+    return df
@@ -1,15 +1,24 @@
 import torch as t
 from torch import Tensor
-from typing import List, Tuple
+from functools import lru_cache
+from typing import List, Tuple, Union
+
+
+def __num_liked(groundTruth: Union[List[Tensor], Tensor], device: t.device) -> Tensor:
+    """Number of ground truth items per user, unless the caller already passed exactly that"""
+    if isinstance(groundTruth, Tensor):
+        return groundTruth.to(device)
+    return t.tensor([len(row) for row in groundTruth], device=device)
 
 
 def RecallPrecision_ATk(
-    groundTruth: List[Tensor], r: Tensor, k: int
+    groundTruth: Union[List[Tensor], Tensor], r: Tensor, k: int
 ) -> Tuple[float, float]:
     """Computers recall @ k and precision @ k
 
     Args:
-        groundTruth (list): list of lists containing highly rated items of each user
+        groundTruth (list): list of lists containing highly rated items of each user,
+            or a tensor with the number of those items per user
         r (list): list of lists indicating whether each top k item recommended to each user
             is a top k ground truth item or not
         k (intg): determines the top k items to compute precision and recall on
@@ -21,18 +30,25 @@ def RecallPrecision_ATk(
         r, dim=-1
     ).float()  # number of correctly predicted items per user
     # number of items liked by each user in the test set
-    user_num_liked = t.Tensor([len(row) for row in groundTruth], device="cpu")
+    user_num_liked = __num_liked(groundTruth, r.device).float()
     recall = t.mean(num_correct_pred / user_num_liked)
     precision = t.mean(num_correct_pred) / k
     return recall.item(), precision.item()
 
 
+@lru_cache(maxsize=None)
+def __discounts(k: int, device: t.device) -> Tensor:
+    """1 / log2(rank + 1) for ranks 1..k, shared between every evaluation with the same k"""
+    return 1.0 / t.log2(t.arange(2, k + 2, device=device))
+
+
 # computes NDCG@K
-def NDCGatK_r(groundTruth: List[Tensor], r: Tensor, k: int) -> float:
+def NDCGatK_r(groundTruth: Union[List[Tensor], Tensor], r: Tensor, k: int) -> float:
     """Computes Normalized Discounted Cumulative Gain (NDCG) @ k
 
     Args:
-        groundTruth (list): list of lists containing highly rated items of each user
+        groundTruth (list): list of lists containing highly rated items of each user,
+            or a tensor with the number of those items per user
         r (list): list of lists indicating whether each top k item recommended to each user
             is a top k ground truth item or not
         k (int): determines the top k items to compute ndcg on
@@ -42,16 +58,12 @@ def NDCGatK_r(groundTruth: List[Tensor], r: Tensor, k: int) -> float:
     """
     assert len(r) == len(groundTruth)
 
-    test_matrix = t.zeros((len(r), k))
-
-    for i, items in enumerate(groundTruth):
-        length = min(len(items), k)
-        test_matrix[i, :length] = 1
-    max_r = test_matrix
-    idcg = t.sum(max_r * 1.0 / t.log2(t.arange(2, k + 2)), axis=1)
-    dcg = r * (1.0 / t.log2(t.arange(2, k + 2)))
-    dcg = t.sum(dcg, axis=1)
-    idcg[idcg == 0.0] = 1.0
-    ndcg = dcg / idcg
-    ndcg[t.isnan(ndcg)] = 0.0
+    # the ideal ranking has min(len(items), k) hits at the top
+    lengths = __num_liked(groundTruth, r.device)
+    max_r = (t.arange(k, device=r.device)[None, :] < lengths[:, None]).float()
+    discounts = __discounts(k, r.device)
+    idcg = t.sum(max_r * discounts, axis=1)
+    dcg = t.sum(r * discounts, axis=1)
+    # users without ground truth have no hits either, they score 0
+    ndcg = t.where(idcg > 0.0, dcg / idcg, t.zeros_like(dcg))
     return t.mean(ndcg).item()
@@ -2,7 +2,6 @@ import torch as t
 import numpy as np
 from torch import Tensor
 from typing import List, Tuple, Optional
-from utils.tensor import difference_1d
 from .metrics import RecallPrecision_ATk, NDCGatK_r
 
 
@@ -45,6 +44,16 @@ def bpr_loss(
     return loss
 
 
+def __items_per_user(edge_index: Tensor) -> dict:
+    """Groups the items by user with one stable sort and a split, instead of scanning
+    every edge once per user. The items keep their order in `edge_index`."""
+    users, order = edge_index[0].sort(stable=True)
+    unique_users, counts = users.unique_consecutive(return_counts=True)
+    return dict(
+        zip(unique_users.tolist(), edge_index[1][order].split(counts.tolist()))
+    )
+
+
 def create_adj_dict(edge_index: Tensor, from_nodes: Optional[Tensor] = None) -> dict:
     """Generates dictionary of items for each user
 
@@ -54,11 +63,11 @@ def create_adj_dict(edge_index: Tensor, from_nodes: Optional[Tensor] = None) ->
     Returns:
         dict: dictionary of items for each user
     """
-    users = edge_index[0].unique(sorted=True) if from_nodes is None else from_nodes
-    items_per_user: dict = {}
-    for user in users:
-        items_per_user[user.item()] = edge_index[1][edge_index[0] == user]
-    return items_per_user
+    items_per_user = __items_per_user(edge_index)
+    if from_nodes is None:
+        return items_per_user
+    no_items = edge_index.new_empty(0)
+    return {user: items_per_user.get(user, no_items) for user in from_nodes.tolist()}
 
 
 def create_adj_list(
@@ -72,8 +81,11 @@ def create_adj_list(
     Returns:
         tensor: List[Tensor] of items for each user
     """
-    users = edge_index[0].unique(sorted=True) if from_nodes is None else from_nodes
-    return [edge_index[1][edge_index[0] == user] for user in users]
+    items_per_user = __items_per_user(edge_index)
+    if from_nodes is None:
+        return list(items_per_user.values())
+    no_items = edge_index.new_empty(0)
+    return [items_per_user.get(user, no_items) for user in from_nodes.tolist()]
 
 
 def get_metrics_lightgcn(
@@ -90,53 +102,71 @@ def get_metrics_lightgcn(
     Returns:
         tuple: recall @ k, precision @ k, ndcg @ k
     """
-    user_embedding = model.users_emb.weight.detach().to("cpu")
-    item_embedding = model.items_emb.weight.detach().to("cpu")
-
-    excluded_edges_per_user = create_adj_dict(t.cat(exclude_edge_indices, dim=1))
+    # stays on the model's device, only the final metrics are copied back
+    user_embedding = model.users_emb.weight.detach()
+    item_embedding = model.items_emb.weight.detach()
 
     # get all unique users in evaluated split
     users = edge_index[0].unique()
 
-    # get the top k recommended items for each user
-    top_K_items = {}
-    for user in users:
-        top_K_items[user.item()] = make_predictions_for_user(
-            user_embedding, item_embedding, user.item(), excluded_edges_per_user, k
-        )
-
-    test_user_pos_items = create_adj_dict(edge_index, from_nodes=users)
-    test_user_pos_items_list = [test_user_pos_items[user.item()] for user in users]
-
-    # determine the correctness of topk predictions
-    r = t.stack(
-        [
-            t.isin(top_K_items[user.item()], test_user_pos_items[user.item()])
-            for user in users
-        ]
+    # get the top k recommended items for each user, row i belongs to users[i]
+    top_K_items = make_predictions_for_users(
+        user_embedding, item_embedding, users, t.cat(exclude_edge_indices, dim=1), k
     )
 
-    recall, precision = RecallPrecision_ATk(test_user_pos_items_list, r, k)
-    ndcg = NDCGatK_r(test_user_pos_items_list, r, k)
+    # determine the correctness of topk predictions, every (user, item) pair is encoded
+    # as a single key so all users are matched against their positives in one call
+    num_items = item_embedding.shape[0]
+    r = t.isin(
+        users[:, None] * num_items + top_K_items,
+        edge_index[0] * num_items + edge_index[1],
+    )
+
+    # number of positives per user, counted once for both metrics instead of grouping the items per user
+    test_user_num_pos_items = t.bincount(edge_index[0])[users]
+    recall, precision = RecallPrecision_ATk(test_user_num_pos_items, r, k)
+    ndcg = NDCGatK_r(test_user_num_pos_items, r, k)
 
     return recall, precision, ndcg
 
 
-def make_predictions_for_user(
+@t.no_grad()
+def make_predictions_for_users(
     user_embeddings: t.Tensor,
     article_embeddings: t.Tensor,
-    user_id: int,
-    positive_items_for_user: dict,
+    users: t.Tensor,
+    excluded_edge_index: t.Tensor,
     num_recommendations: int,
+    batch_size: int = 256,
 ) -> t.Tensor:
-    articles_to_ignore = (
-        positive_items_for_user[user_id]
-        if user_id in positive_items_for_user
-        else t.tensor([])
-    )
-    scores = user_embeddings[user_id] @ article_embeddings.T
-
-    _, indices = t.topk(scores, k=num_recommendations + len(articles_to_ignore))
-    # remove positive items, we don't want to recommend them
-    indices = difference_1d(indices, articles_to_ignore, assume_unique=True)
-    return indices[:num_recommendations]
+    """Top k recommendations for many users: every batch of users is scored with a single matmul,
+    the per-batch top k are concatenated once at the end. Row i holds the recommendations for users[i].
+    `excluded_edge_index` (2 by N, eg. the positive edges) holds the items we don't want to recommend."""
+    device = user_embeddings.device
+    users = users.to(device)
+    excluded_edge_index = excluded_edge_index.to(device)
+
+    # turn the excluded edges into (row in `users`, item) pairs sorted by row, so each batch is one slice
+    positions = t.full((user_embeddings.shape[0],), -1, dtype=t.long, device=device)
+    positions[users] = t.arange(len(users), device=device)
+    excluded_rows = positions[excluded_edge_index[0]]
+    scored = excluded_rows >= 0
+    excluded_rows, order = excluded_rows[scored].sort()
+    excluded_items = excluded_edge_index[1][scored][order]
+
+    # slice bounds of every batch, found with one searchsorted and one device sync
+    batch_starts = list(range(0, len(users), batch_size))
+    bounds = t.searchsorted(
+        excluded_rows,
+        t.arange(0, len(users) + batch_size, batch_size, device=device),
+    ).tolist()
+
+    predictions = []
+    for batch, start in enumerate(batch_starts):
+        end = min(start + batch_size, len(users))
+        scores = user_embeddings[users[start:end]] @ article_embeddings.T
+        lo, hi = bounds[batch], bounds[batch + 1]
+        # remove positive items with a single scatter, we don't want to recommend them
+        scores[excluded_rows[lo:hi] - start, excluded_items[lo:hi]] = -float("inf")
+        predictions.append(t.topk(scores, k=num_recommendations, dim=1).indices)
+    return t.cat(predictions, dim=0)
@@ -1,9 +1,104 @@
 import pandas as pd
+import json
+import hashlib
 import torch as t
 import numpy as np
-from typing import Tuple, Optional
+from typing import Any, Callable, Dict, List, Tuple, Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+import os
 import numpy as np
 from utils.constants import Constants
+from utils.tensor import save_csr
+
+
+def read_parquet(
+    path: str, columns: List[str], num_rows: Optional[int] = None
+) -> pd.DataFrame:
+    """pd.read_parquet that only deserializes `columns` (the ones present in the file) and, with `num_rows`,
+    only the first row groups instead of the whole file. The Arrow buffers are released while converting."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    columns = [column for column in columns if column in parquet_file.schema_arrow.names]
+    if num_rows is None:
+        table = parquet_file.read(columns=columns, use_pandas_metadata=True)
+    else:
+        batches, rows_read = [], 0
+        for batch in parquet_file.iter_batches(batch_size=num_rows, columns=columns):
+            batches.append(batch)
+            rows_read += batch.num_rows
+            if rows_read >= num_rows:
+                break
+        schema = pa.schema([parquet_file.schema_arrow.field(c) for c in columns])
+        table = pa.Table.from_batches(batches, schema=schema).slice(0, num_rows)
+    return table.to_pandas(self_destruct=True, split_blocks=True)
+
+
+# Part of the cache key of the encoded frames, bump it whenever the encoding in
+# load_encoded_frames or the stored format changes
+FRAMES_CACHE_VERSION = 1
+
+
+def read_cached_frames(
+    names: List[str],
+    key: dict,
+    input_paths: List[str],
+    compute: Callable[[], Tuple[pd.DataFrame, ...]],
+    cache_dir: str = "data/derived/cache",
+) -> Tuple[pd.DataFrame, ...]:
+    """Returns the frames of `compute()` (one per name), checkpointed as Arrow IPC files keyed by `key` and
+    the mtimes of `input_paths`. A hit memory-maps the files instead of computing the frames again.
+    Every name has a single file which a miss overwrites, the key of its content is stored next to it."""
+    import pyarrow as pa
+
+    digest = hashlib.sha1(
+        json.dumps(
+            {
+                **key,
+                "version": FRAMES_CACHE_VERSION,
+                "mtimes": [os.path.getmtime(path) for path in input_paths],
+            },
+            sort_keys=True,
+            default=str,
+        ).encode()
+    ).hexdigest()
+    paths = [os.path.join(cache_dir, f"{name}.arrow") for name in names]
+    key_path = os.path.join(cache_dir, "_".join(names) + ".key")
+    if os.path.exists(key_path) and all(os.path.exists(path) for path in paths):
+        with open(key_path) as f:
+            if f.read() == digest:
+                return tuple(
+                    pa.ipc.open_file(pa.memory_map(path))
+                    .read_all()
+                    .to_pandas(self_destruct=True, split_blocks=True)
+                    for path in paths
+                )
+
+    frames = compute()
+    os.makedirs(cache_dir, exist_ok=True)
+    # the key is written last, an interrupted run never leaves a hit on partial files
+    if os.path.exists(key_path):
+        os.remove(key_path)
+    for frame, path in zip(frames, paths):
+        table = pa.Table.from_pandas(frame)
+        with pa.OSFile(path + ".tmp", "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(path + ".tmp", path)
+    with open(key_path, "w") as f:
+        f.write(digest)
+    return frames
+
+
+def frame_to_long_tensor(df: pd.DataFrame, out: Optional[t.Tensor] = None) -> t.Tensor:
+    """t.tensor(df.to_numpy(), dtype=t.long) with a single copy: the columns are written straight
+    into a row-major int64 buffer, which the returned tensor shares.
+    With `out` (a CPU tensor) the integer values are written into its first columns instead."""
+    values = np.empty(df.shape, dtype=np.int64) if out is None else out.numpy()
+    for i in range(df.shape[1]):
+        values[:, i] = df.iloc[:, i].to_numpy().astype(np.int64, copy=False)
+    return t.from_numpy(values) if out is None else out
 
 
 def create_data_pyg(
@@ -11,8 +106,8 @@ def create_data_pyg(
     articles: t.Tensor,
     extra_nodes: Optional[t.Tensor],
     extra_node_name: Optional[str],
-    transactions_to_customer_id: np.ndarray,
-    transactions_to_article_id: np.ndarray,
+    transactions_to_customer_id: Union[np.ndarray, t.Tensor],
+    transactions_to_article_id: Union[np.ndarray, t.Tensor],
     extra_edges_from_article_id: Optional[np.ndarray],
     extra_edges_to_extra_node_id: Optional[np.ndarray],
     extra_edge_type_label: Optional[str],
@@ -26,9 +121,13 @@ def create_data_pyg(
     if extra_nodes is not None:
         data[extra_node_name].x = extra_nodes
 
-    data[Constants.edge_key].edge_index = t.as_tensor(
-        (transactions_to_customer_id, transactions_to_article_id),
-        dtype=t.long,
+    # as_tensor does not copy long tensors (e.g. slices shared between the splits),
+    # the stack is the only copy and leaves the graph with storage of its own
+    data[Constants.edge_key].edge_index = t.stack(
+        (
+            t.as_tensor(transactions_to_customer_id, dtype=t.long),
+            t.as_tensor(transactions_to_article_id, dtype=t.long),
+        )
     )
     if extra_edge_type_label is not None:
         data[
@@ -72,18 +171,133 @@ def create_data_dgl(
 
 def create_ids_and_maps(
     df: pd.DataFrame, column: str, start: int
-) -> Tuple[pd.DataFrame, dict, dict]:
+) -> Tuple[pd.DataFrame, dict, pd.Series]:
+    """Assigns contiguous ids from `start` to the (unique) values of `column`.
+    The reverse mapping is a Series indexed by the original value, built from the arrays
+    directly instead of a dict comprehension, ready for a vectorized Series.map.
+    Its ids are int32, so the mapped edge columns stay narrow until they become tensors."""
     df.reset_index(inplace=True)
     df.index += start
     mapping_forward = df[column].to_dict()
-    mapping_reverse = {v: k for k, v in mapping_forward.items()}
+    mapping_reverse = pd.Series(
+        df.index.to_numpy().astype(np.int32), index=df[column].to_numpy()
+    )
     df["index"] = df.index
     return df, mapping_forward, mapping_reverse
 
 
-def extract_edges(transactions: pd.DataFrame) -> dict:
-    return transactions.groupby("customer_id")["article_id"].apply(list).to_dict()
+def map_ids(ids: pd.Series, mapping_reverse: pd.Series) -> pd.Series:
+    """Maps original ids through a reverse mapping of create_ids_and_maps.
+    Series.map turns unknown ids into NaN (where a dict lookup raised a KeyError), fail on them
+    here instead of letting them reach the edge tensors as garbage indices."""
+    mapped = ids.map(mapping_reverse)
+    assert mapped.notna().all(), f"{mapped.isna().sum()} {ids.name} values have no id"
+    return mapped.astype(np.int32)
+
+
+def nested_splits(
+    transactions: pd.DataFrame,
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """The train, val (train + val) and test (train + val + test) transactions, in the same row order as
+    concatenating the masked frames. The rows are ordered train -> val -> test by one stable sort,
+    after which every split is a prefix of them instead of a copy of the previous split."""
+    masks = [
+        (transactions[mask] == True).to_numpy()
+        for mask in ("train_mask", "val_mask", "test_mask")
+    ]
+    tiers = np.select(masks, [0, 1, 2], default=3)
+    ordered = transactions.iloc[np.argsort(tiers, kind="stable")]
+    train_end, val_end, test_end = np.bincount(tiers, minlength=4).cumsum()[:3]
+    return ordered.iloc[:train_end], ordered.iloc[:val_end], ordered.iloc[:test_end]
+
+
+def save_json(obj: dict, path: str) -> None:
+    """json.dump without the whitespace, through orjson when it is installed.
+    Both write plain json (int keys become strings), read back with json.load."""
+    try:
+        import orjson
+    except ImportError:
+        with open(path, "w") as fp:
+            json.dump(obj, fp, separators=(",", ":"))
+        return
+    with open(path, "wb") as fp:
+        fp.write(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS))
+
+
+def save_adjacency(
+    keys: np.ndarray, values: np.ndarray, num_nodes: int, path: str
+) -> None:
+    """Saves the `keys` -> `values` adjacency as a dict (see group_to_dict), followed by its memory-mappable
+    CSR binaries (see utils.tensor.load_csr). The CSR is built from the sorted arrays, not from the dict's lists."""
+    keys, values = sort_groups(keys, values)
+    t.save(sorted_groups_to_dict(keys, values), path)
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    indptr[1:] = np.bincount(keys, minlength=num_nodes).cumsum()
+    save_csr(t.from_numpy(indptr), t.from_numpy(values), path)
+
+
+def sort_groups(keys: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sorts the (key, value) pairs by key with a stable argsort, the values of a key keep their order"""
+    order = np.argsort(keys, kind="stable")
+    return keys[order], values[order]
+
+
+def sorted_groups_to_dict(keys: np.ndarray, values: np.ndarray) -> dict:
+    """group_to_dict for pairs that are already sorted by key"""
+    if len(keys) == 0:
+        return dict()
+    group_starts = np.flatnonzero(np.diff(keys)) + 1
+    return dict(
+        zip(
+            keys[np.concatenate(([0], group_starts))].tolist(),
+            [group.tolist() for group in np.split(values, group_starts)],
+        )
+    )
+
+
+def group_to_dict(keys: np.ndarray, values: np.ndarray) -> dict:
+    """Same as `groupby(keys)[values].apply(list).to_dict()`: sorted keys, values in their original order.
+    One stable argsort and split in numpy, python is only touched once per group instead of once per row"""
+    return sorted_groups_to_dict(*sort_groups(keys, values))
+
+
+def extract_and_save_adjacencies(
+    transactions: pd.DataFrame,
+    num_customers: int,
+    num_articles: int,
+    edges_path: str,
+    rev_edges_path: str,
+) -> None:
+    """Saves the edges per customer and the reverse edges per article, the id columns are pulled out of the frame once"""
+    customer_ids = transactions["customer_id"].to_numpy()
+    article_ids = transactions["article_id"].to_numpy()
+    save_adjacency(customer_ids, article_ids, num_customers, edges_path)
+    save_adjacency(article_ids, customer_ids, num_articles, rev_edges_path)
 
 
-def extract_reverse_edges(transactions: pd.DataFrame) -> dict:
-    return transactions.groupby("article_id")["customer_id"].apply(list).to_dict()
+def save_splits(
+    graphs: Dict[str, Any],
+    transactions: Dict[str, pd.DataFrame],
+    num_customers: int,
+    num_articles: int,
+    directory: str = "data/derived",
+) -> None:
+    """Saves the `{split}_graph.pt` of every split and its `edges_{split}.pt` / `rev_edges_{split}.pt` adjacencies.
+    Only the t.save of the already built graphs runs in background threads, the adjacencies are built one split
+    at a time on the calling thread: building them holds the GIL for the most part (tolist, dicts, pickling) and
+    doing the splits at once would keep the python dicts of every split in memory together."""
+    with ThreadPoolExecutor(max_workers=len(graphs)) as executor:
+        futures = [
+            executor.submit(t.save, graph, f"{directory}/{split}_graph.pt")
+            for split, graph in graphs.items()
+        ]
+        for split, split_transactions in transactions.items():
+            extract_and_save_adjacencies(
+                split_transactions,
+                num_customers,
+                num_articles,
+                f"{directory}/edges_{split}.pt",
+                f"{directory}/rev_edges_{split}.pt",
+            )
+    for future in futures:
+        future.result()
@@ -1,8 +1,9 @@
 import torch as t
 from torch import Tensor
-from typing import List, Union
+from typing import List, Optional, Tuple, Union
 import torch.nn.functional as F
 import numpy as np
+import os
 
 
 def intersection_1d(t1: Tensor, t2: Tensor) -> Tensor:
@@ -21,6 +22,114 @@ def difference_1d(a: Tensor, b: Tensor, assume_unique: bool) -> Tensor:
     return t.tensor(diff)
 
 
+def adjacency_to_csr(adjacency: dict, num_nodes: int) -> Tuple[Tensor, Tensor]:
+    r"""Flattens an adjacency dict (node id -> list of neighbour ids) into CSR (indptr, indices) tensors"""
+    degrees = t.zeros(num_nodes, dtype=t.long)
+    node_ids = sorted(adjacency.keys())
+    degrees[t.as_tensor(node_ids, dtype=t.long)] = t.as_tensor(
+        [len(adjacency[node_id]) for node_id in node_ids], dtype=t.long
+    )
+    indptr = t.zeros(num_nodes + 1, dtype=t.long)
+    indptr[1:] = degrees.cumsum(0)
+    indices = t.as_tensor(
+        [neighbour for node_id in node_ids for neighbour in adjacency[node_id]],
+        dtype=t.long,
+    )
+    return indptr, indices
+
+
+def csr_paths(adjacency_path: str) -> Tuple[str, str]:
+    r"""Paths of the flat (indptr, indices) binaries stored next to an adjacency dict file"""
+    prefix = os.path.splitext(adjacency_path)[0]
+    return prefix + ".indptr.bin", prefix + ".indices.bin"
+
+
+def save_csr(indptr: Tensor, indices: Tensor, adjacency_path: str) -> None:
+    r"""Stores CSR tensors as raw binaries (int64 indptr, int32 indices) that load_csr can memory-map"""
+    indptr_path, indices_path = csr_paths(adjacency_path)
+    indptr.numpy().astype(np.int64).tofile(indptr_path)
+    indices.numpy().astype(np.int32).tofile(indices_path)
+
+
+def load_csr(adjacency_path: str) -> Optional[Tuple[Tensor, Tensor]]:
+    r"""Memory-maps the CSR binaries written by save_csr, None if they do not exist, are older than
+    the adjacency dict file (left over from an earlier run) or do not fit together.
+    Pages are shared between processes through the OS page cache and nothing is unpickled.
+    The indices stay int32 on disk and in memory, gathers from them have to be cast to long"""
+    indptr_path, indices_path = csr_paths(adjacency_path)
+    if not (os.path.exists(indptr_path) and os.path.exists(indices_path)):
+        return None
+    if os.path.exists(adjacency_path) and min(
+        os.path.getmtime(indptr_path), os.path.getmtime(indices_path)
+    ) < os.path.getmtime(adjacency_path):
+        return None
+    indptr = np.fromfile(indptr_path, dtype=np.int64)
+    num_indices = os.path.getsize(indices_path) // np.dtype(np.int32).itemsize
+    if len(indptr) == 0 or indptr[-1] != num_indices:
+        return None
+    if num_indices == 0:
+        # an empty file can not be memory-mapped
+        return t.from_numpy(indptr), t.zeros(0, dtype=t.int32)
+    return (
+        t.from_numpy(indptr),
+        t.from_numpy(np.memmap(indices_path, dtype=np.int32, mode="c")),
+    )
+
+
+def load_adjacency_csr(
+    adjacency_path: str, num_nodes: Optional[int] = None
+) -> Tuple[Tensor, Tensor]:
+    """Returns the CSR (indptr, indices) form of an adjacency dict file, so neighbour lookups are tensor slices.
+    Uses the memory-mapped binaries written during preprocessing if they exist, otherwise the dict is
+    loaded and flattened, and only the CSR tensors are kept.
+    `num_nodes` defaults to the largest node id with neighbours + 1.
+    """
+    csr = load_csr(adjacency_path)
+    if csr is None:
+        adjacency = t.load(adjacency_path)
+        if num_nodes is None:
+            num_nodes = max(adjacency.keys(), default=-1) + 1
+        csr = adjacency_to_csr(adjacency, num_nodes)
+    return csr
+
+
+def csr_neighbours(indptr: Tensor, indices: Tensor, node_id: int) -> Tensor:
+    r"""Returns the neighbours of a single node, a view into the CSR indices if they are already long"""
+    return indices[indptr[node_id] : indptr[node_id + 1]].long()
+
+
+def csr_edges(indptr: Tensor, indices: Tensor, node_ids: Tensor) -> Tensor:
+    r"""Returns every edge leaving `node_ids` as a [2, num_edges] tensor, gathered from the CSR arrays in one go"""
+    starts = indptr[node_ids]
+    degrees = indptr[node_ids + 1] - starts
+    sources = node_ids.repeat_interleave(degrees)
+    # position of each edge inside its own segment: 0, 1, .., degree - 1
+    offsets = t.arange(sources.numel(), device=sources.device) - (
+        degrees.cumsum(0) - degrees
+    ).repeat_interleave(degrees)
+    targets = indices[starts.repeat_interleave(degrees) + offsets].long()
+    return t.stack([sources, targets])
+
+
+def unique_unsorted(values: Tensor, scratch: Tensor) -> Tensor:
+    r"""Deduplicates `values` in O(n) without sorting.
+    `scratch` is a long tensor covering the range of `values`, its content is overwritten and can be anything"""
+    positions = t.arange(values.numel(), device=values.device)
+    scratch[values] = positions
+    # only one of the positions written for a repeated value survives the scatter
+    return values[scratch[values] == positions]
+
+
+def remap_to_positions(values: Tensor, buckets: Tensor) -> Tensor:
+    r"""Maps every value to its position in `buckets` (which has to contain all of them)
+    with a direct-addressed lookup table, O(n) instead of the O(n log b) of t.bucketize"""
+    if buckets.numel() == 0:
+        return values.long()
+    lookup = t.empty(int(buckets.max()) + 1, dtype=t.long, device=buckets.device)
+    lookup[buckets.long()] = t.arange(buckets.numel(), device=buckets.device)
+    return lookup[values.long()]
+
+
 def padded_stack(
     tensors: List[t.Tensor],
     side: str = "right",